@@ -1,16 +1,31 @@
+import time
+inicio_importaciones = time.perf_counter() # Se anota en MÉTRICAS: en frío al arrancar, casi nada en cada recarga
 import streamlit as st
 import pandas as pd
+import numpy as np
 import gspread
-from oauth2client.service_account import ServiceAccountCredentials
 from datetime import datetime, timedelta, time as datetime_time
-import time
 import os
-import streamlit_javascript as st_js
+import sys
+import importlib
+import threading
+import re
+import json
+import csv
+import random
+import gzip
+import sqlite3
+import functools
+from collections import deque
+from contextlib import contextmanager
+import pyarrow as pa
+import pyarrow.parquet as pq
 import io
 import uuid
 import hashlib
-from streamlit_calendar import calendar 
 import pytz 
+# openpyxl, streamlit_calendar, streamlit_javascript y oauth2client se importan bajo demanda (ver importar)
+ms_importaciones = (time.perf_counter() - inicio_importaciones) * 1000
 
 # --- CONFIGURACIÓN DE ZONA HORARIA ---
 ZONA_HORARIA = pytz.timezone('Europe/Madrid')
@@ -34,58 +49,1048 @@ try:
     INSPECTION_PASSWORD = st.secrets["general"]["inspection_password"]
     SHEET_NAME = st.secrets["general"]["sheet_name"]
     APP_URL = st.secrets["general"].get("app_url", "https://tu-app.streamlit.app")
+    # Opcional: SQLite en un volumen común para que varias réplicas compartan las hojas leídas
+    CACHE_COMPARTIDA = st.secrets["general"].get("cache_compartida", "")
+    # Réplicas que comparten la cuenta de servicio: cada una se queda con su parte de la cuota de Sheets
+    REPLICAS = max(1, int(st.secrets["general"].get("replicas", 1)))
 except Exception as e:
     st.error(f"⚠️ Error Crítico: Faltan secretos de configuración. {e}")
     st.stop()
 
+# --- MÉTRICAS DE RENDIMIENTO ---
+# Tiempos (ms) y contadores de las operaciones calientes, comunes a todas las sesiones del proceso.
+# De cada tiempo se guardan las últimas MUESTRAS_METRICA medidas para los percentiles, más el total y la suma.
+MUESTRAS_METRICA = 2000
+PERCENTILES = (50, 90, 99)
+
+@st.cache_resource
+def metricas():
+    """'hilo' cuenta las peticiones a Sheets del hilo actual, para saber cuántas hace cada recarga"""
+    return {"lock": threading.Lock(), "tiempos": {}, "contadores": {}, "desde": obtener_ahora(), "hilo": threading.local(),
+            "importado": False}
+
+def anotar_tiempo(nombre, ms):
+    m = metricas()
+    with m["lock"]:
+        t = m["tiempos"].get(nombre)
+        if t is None: t = m["tiempos"][nombre] = {"muestras": deque(maxlen=MUESTRAS_METRICA), "n": 0, "suma": 0.0}
+        t["muestras"].append(ms)
+        t["n"] += 1
+        t["suma"] += ms
+
+def contar(nombre, n=1):
+    m = metricas()
+    with m["lock"]: m["contadores"][nombre] = m["contadores"].get(nombre, 0) + n
+
+@contextmanager
+def medir(nombre):
+    t = time.perf_counter()
+    try: yield
+    finally: anotar_tiempo(nombre, (time.perf_counter() - t) * 1000)
+
+def medido(nombre):
+    """Decorador: cronometra cada llamada a la función bajo 'nombre'"""
+    def decorador(funcion):
+        @functools.wraps(funcion)
+        def envoltura(*args, **kwargs):
+            with medir(nombre): return funcion(*args, **kwargs)
+        return envoltura
+    return decorador
+
+def importar(modulo):
+    """Módulo pesado que solo usan algunas ramas (exportación, calendarios, firma del dispositivo, credenciales):
+    se importa la primera vez que hace falta y se anota cuánto costó; después sale de sys.modules."""
+    if modulo in sys.modules: return sys.modules[modulo]
+    with medir(f"importacion:{modulo}"): return importlib.import_module(modulo)
+
+def anotar_importaciones(ms):
+    """La primera ejecución del script en el proceso paga las importaciones en frío; las demás, solo la búsqueda"""
+    m = metricas()
+    with m["lock"]: arranque, m["importado"] = not m["importado"], True
+    anotar_tiempo("arranque.importaciones" if arranque else "recarga.importaciones", ms)
+
+anotar_importaciones(ms_importaciones)
+
+def peticiones_del_hilo(reiniciar=False):
+    hilo = metricas()["hilo"]
+    n = getattr(hilo, "peticiones", 0)
+    if reiniciar: hilo.peticiones = 0
+    return n
+
+def reiniciar_metricas():
+    m = metricas()
+    with m["lock"]:
+        m["tiempos"].clear()
+        m["contadores"].clear()
+        m["desde"] = obtener_ahora()
+
+def resumen_metricas():
+    """Por cada tiempo: llamadas totales, media y percentiles de las últimas muestras; y los contadores"""
+    m = metricas()
+    with m["lock"]:
+        tiempos = {k: (sorted(v["muestras"]), v["n"], v["suma"]) for k, v in m["tiempos"].items()}
+        contadores, desde = dict(m["contadores"]), m["desde"]
+    filas = []
+    for nombre, (orden, n, suma) in sorted(tiempos.items()):
+        fila = {"metrica": nombre, "llamadas": n, "suma_ms": round(suma, 3), "media_ms": round(suma / n, 3)}
+        for p in PERCENTILES: fila[f"p{p}_ms"] = round(orden[min(len(orden) - 1, len(orden) * p // 100)], 3)
+        fila["max_ms"] = round(orden[-1], 3)
+        filas.append(fila)
+    return {"desde": desde.isoformat(timespec="seconds"), "tiempos": filas, "contadores": dict(sorted(contadores.items()))}
+
+def metricas_prometheus(resumen):
+    """Texto en el formato de exposición de Prometheus: un summary de tiempos y un contador de eventos"""
+    etiqueta = lambda v: v.replace("\\", "\\\\").replace('"', '\\"')
+    lineas = ["# HELP asistencia_tiempo_ms Duración de las operaciones en milisegundos.", "# TYPE asistencia_tiempo_ms summary"]
+    for f in resumen["tiempos"]:
+        m = etiqueta(f["metrica"])
+        for p in PERCENTILES: lineas.append(f'asistencia_tiempo_ms{{metrica="{m}",quantile="{p / 100}"}} {f[f"p{p}_ms"]}')
+        lineas.append(f'asistencia_tiempo_ms_sum{{metrica="{m}"}} {f["suma_ms"]}')
+        lineas.append(f'asistencia_tiempo_ms_count{{metrica="{m}"}} {f["llamadas"]}')
+    lineas += ["# HELP asistencia_eventos_total Eventos contados desde el arranque.", "# TYPE asistencia_eventos_total counter"]
+    for nombre, n in resumen["contadores"].items(): lineas.append(f'asistencia_eventos_total{{evento="{etiqueta(nombre)}"}} {n}')
+    return "\n".join(lineas) + "\n"
+
 # --- CONEXIÓN BASE A GOOGLE SHEETS ---
-def conectar_google_sheets(nombre_hoja_especifica):
-    scope = ['https://spreadsheets.google.com/feeds',
-             'https://www.googleapis.com/auth/drive']
-    
+SCOPE_GOOGLE = ['https://spreadsheets.google.com/feeds',
+                'https://www.googleapis.com/auth/drive']
+
+def obtener_credenciales():
+    ServiceAccountCredentials = importar("oauth2client.service_account").ServiceAccountCredentials
     if "gcp_service_account" in st.secrets:
         creds_dict = dict(st.secrets["gcp_service_account"])
-        creds = ServiceAccountCredentials.from_json_keyfile_dict(creds_dict, scope)
+        return ServiceAccountCredentials.from_json_keyfile_dict(creds_dict, SCOPE_GOOGLE)
     elif os.path.exists('credentials.json'):
-        creds = ServiceAccountCredentials.from_json_keyfile_name('credentials.json', scope)
-    else:
-        st.error("⚠️ Error de credenciales.")
-        st.stop()
-    
-    client = gspread.authorize(creds)
-    try:
-        sheet = client.open(SHEET_NAME).worksheet(nombre_hoja_especifica)
+        return ServiceAccountCredentials.from_json_keyfile_name('credentials.json', SCOPE_GOOGLE)
+    st.error("⚠️ Error de credenciales.")
+    st.stop()
+
+@st.cache_resource
+def pool_conexiones():
+    """Cliente autorizado, libro y hojas abiertas, compartidos por todas las sesiones del proceso.
+    El cliente renueva el token OAuth por sí solo al caducar, así que solo se autoriza una vez."""
+    return {"lock": threading.Lock(), "cliente": None, "libro": None, "hojas": {}}
+
+def invalidar_conexion(nombre_hoja=None):
+    """Descarta la hoja indicada (o todo el pool si no se indica) para reabrirla en el siguiente uso"""
+    pool = pool_conexiones()
+    with pool["lock"]:
+        if nombre_hoja is None:
+            pool["cliente"] = None
+            pool["hojas"].clear()
+        else:
+            pool["hojas"].pop(nombre_hoja, None)
+        pool["libro"] = None
+
+def conectar_google_sheets(nombre_hoja_especifica):
+    pool = pool_conexiones()
+    with pool["lock"]:
+        sheet = pool["hojas"].get(nombre_hoja_especifica)
+        if sheet is not None:
+            contar("conexion.reutilizada")
+            return sheet
+        with medir("conexion.abrir"):
+            if pool["cliente"] is None:
+                pool["cliente"] = gspread.authorize(obtener_credenciales())
+            try:
+                if pool["libro"] is None:
+                    pool["libro"] = pool["cliente"].open(SHEET_NAME)
+                sheet = pool["libro"].worksheet(nombre_hoja_especifica)
+            except gspread.exceptions.WorksheetNotFound:
+                # Solo una hoja que no existe es None; cuota, red o credenciales suben a quien llama
+                contar("conexion.fallida")
+                return None
+        pool["hojas"][nombre_hoja_especifica] = sheet
         return sheet
-    except:
-        return None
 
-# --- FUNCIONES DE LECTURA ---
-def leer_con_reintento(nombre_hoja):
-    max_intentos = 3
-    for i in range(max_intentos):
+def es_error_de_conexion(e):
+    """Errores que se arreglan reabriendo la conexión: token rechazado o hoja que ya no se encuentra"""
+    if isinstance(e, (gspread.exceptions.WorksheetNotFound, gspread.exceptions.SpreadsheetNotFound)): return True
+    return isinstance(e, gspread.exceptions.APIError) and e.code in (401, 404)
+
+def es_error_transitorio(e, escritura):
+    """Errores que se arreglan esperando: cuota agotada (429) y, en lecturas, fallos del servidor (5xx)
+    o de red (requests.RequestException hereda de OSError). Una escritura solo se repite con 429, porque
+    Google la rechaza antes de aplicarla; tras un 5xx pudo quedar hecha y repetirla duplicaría filas."""
+    if isinstance(e, gspread.exceptions.APIError):
+        return e.code == 429 or (not escritura and e.code >= 500)
+    return not escritura and isinstance(e, OSError)
+
+# --- PLANIFICADOR DE PETICIONES (CUOTAS DE GOOGLE SHEETS) ---
+# Todas las llamadas a Sheets pasan por aquí. Google limita lecturas y escrituras por minuto y por usuario
+# (la cuenta de servicio es un único usuario para todas las sesiones), así que cada tipo tiene su cubo de
+# fichas: cabe una ráfaga corta y el resto se reparte a ritmo constante, de forma que en ningún minuto
+# se pasa de la cuota. Las peticiones prioritarias (volcado de fichajes) se saltan la fila y tienen
+# unas fichas de reserva que las normales (auditoría, maestros) no pueden gastar.
+# Con varias réplicas cada proceso tiene su cubo, así que la cuota (ráfaga incluida) se reparte entre REPLICAS.
+CUOTA_LECTURAS_MINUTO = 60
+CUOTA_ESCRITURAS_MINUTO = 60
+RAFAGA_CUOTA = 10
+RESERVA_PRIORITARIA = 2
+REINTENTOS_SHEETS = 4
+ESPERA_MAXIMA_SHEETS = 32
+
+@st.cache_resource
+def planificador():
+    def cubo(cuota):
+        cuota = cuota / REPLICAS
+        rafaga = max(min(RAFAGA_CUOTA, cuota / 2), RESERVA_PRIORITARIA + 1)
+        return {"fichas": rafaga, "rafaga": rafaga, "ritmo": max(cuota - rafaga, 1) / 60, "ts": time.monotonic(), "prioritarias": 0}
+    return {"cond": threading.Condition(), "cubos": {"lectura": cubo(CUOTA_LECTURAS_MINUTO),
+            "escritura": cubo(CUOTA_ESCRITURAS_MINUTO)}, "en_vuelo": {}}
+
+def tomar_turno(tipo, prioritaria=False):
+    """Bloquea hasta que haya una ficha para una llamada del tipo dado y la gasta"""
+    plan = planificador()
+    cubo = plan["cubos"][tipo]
+    with medir(f"cuota.espera:{tipo}"), plan["cond"]:
+        if prioritaria: cubo["prioritarias"] += 1
         try:
+            while True:
+                ahora = time.monotonic()
+                cubo["fichas"] = min(cubo["rafaga"], cubo["fichas"] + (ahora - cubo["ts"]) * cubo["ritmo"])
+                cubo["ts"] = ahora
+                necesarias = 1 if prioritaria else 1 + RESERVA_PRIORITARIA
+                if cubo["fichas"] >= necesarias and (prioritaria or not cubo["prioritarias"]):
+                    cubo["fichas"] -= 1
+                    return
+                plan["cond"].wait(max((necesarias - cubo["fichas"]) / cubo["ritmo"], 0.05))
+        finally:
+            if prioritaria:
+                cubo["prioritarias"] -= 1
+                plan["cond"].notify_all()
+
+def vaciar_cubo(tipo):
+    """Google devolvió 429: se deja de pedir hasta que el cubo se rellene"""
+    contar(f"sheets.429:{tipo}")
+    plan = planificador()
+    with plan["cond"]:
+        plan["cubos"][tipo]["fichas"] = min(plan["cubos"][tipo]["fichas"], 0.0)
+
+def peticion_unica(clave, funcion):
+    """Single-flight: si ya hay en curso una lectura idéntica, se espera su resultado en lugar de repetirla"""
+    plan = planificador()
+    with plan["cond"]:
+        vuelo = plan["en_vuelo"].get(clave)
+        lider = vuelo is None
+        if lider: vuelo = plan["en_vuelo"][clave] = {"hecho": threading.Event(), "resultado": None, "error": None}
+    if not lider:
+        contar("sheets.compartida")
+        vuelo["hecho"].wait()
+        if vuelo["error"] is not None: raise vuelo["error"]
+        return vuelo["resultado"]
+    try:
+        vuelo["resultado"] = funcion()
+        return vuelo["resultado"]
+    except Exception as e:
+        vuelo["error"] = e
+        raise
+    finally:
+        with plan["cond"]: del plan["en_vuelo"][clave]
+        vuelo["hecho"].set()
+
+def ejecutar_en_hoja(nombre_hoja, operacion, escritura=False, prioritaria=False, clave=None):
+    """Ejecuta operacion(sheet) sobre la hoja del pool cuando el planificador da turno. Con 429/5xx reintenta
+    con espera exponencial y jitter; si falla la autenticación o la hoja no se encuentra, reabre la conexión
+    y lo intenta una vez más. Las lecturas con 'clave' se comparten con las idénticas que estén en curso."""
+    if clave is not None and not escritura:
+        return peticion_unica((nombre_hoja, clave), lambda: ejecutar_en_hoja(nombre_hoja, operacion, prioritaria=prioritaria))
+    tipo = "escritura" if escritura else "lectura"
+    reconectado, intento = False, 0
+    while True:
+        try:
+            # Abrir la hoja también es una petición: un 429 o un fallo de red aquí se reintenta como los demás
             sheet = conectar_google_sheets(nombre_hoja)
-            if sheet:
-                return sheet.get_all_records()
-            return []
+            if sheet is None:
+                if not reconectado:
+                    invalidar_conexion(nombre_hoja)
+                    reconectado = True
+                    continue
+                raise gspread.exceptions.WorksheetNotFound(nombre_hoja)
+            tomar_turno(tipo, prioritaria)
+            hilo = metricas()["hilo"]
+            hilo.peticiones = getattr(hilo, "peticiones", 0) + 1
+            with medir(f"sheets.{tipo}"): return operacion(sheet)
         except Exception as e:
-            if i == max_intentos - 1:
-                st.error(f"⚠️ Error de conexión con Google Sheets ({nombre_hoja}): {e}")
-                return []
-            time.sleep(2 * (i + 1)) 
-    return []
+            contar(f"sheets.error:{getattr(e, 'code', type(e).__name__)}")
+            if es_error_de_conexion(e) and not reconectado:
+                es_auth = isinstance(e, gspread.exceptions.APIError) and e.code == 401
+                invalidar_conexion(None if es_auth else nombre_hoja)
+                reconectado = True
+                continue
+            if intento >= REINTENTOS_SHEETS or not es_error_transitorio(e, escritura): raise
+            if isinstance(e, gspread.exceptions.APIError) and e.code == 429: vaciar_cubo(tipo)
+            contar("sheets.reintento")
+            espera = min(2 ** intento, ESPERA_MAXIMA_SHEETS)
+            time.sleep(espera + random.uniform(0, espera / 2))
+            intento += 1
+
+# --- ESPEJO LOCAL DE HOJAS (SINCRONIZACIÓN INCREMENTAL) ---
+TTL_REGISTROS = 60
+TTL_MAESTROS = 600
+TTL_PARTICIONES = 3600
+RECONCILIACION_COMPLETA = 300 # Cada cuánto una sincronización incremental relee la hoja entera
+ANTICIPO_REFRESCO = 0.8 # El refresco anticipado salta al 80 % del TTL
 
-@st.cache_data(ttl=600)
+@st.cache_resource
+def registro_espejos():
+    """Nombre de hoja -> espejo, para que el refresco anticipado sepa qué hay cargado"""
+    return {}
+
+@st.cache_resource
+def espejo_hoja(nombre_hoja):
+    """Copia local de una hoja compartida por todas las sesiones del proceso.
+    'filas' guarda los valores crudos ya ingeridos: la última está en la fila len(filas) + 1 de la hoja;
+    'sync' es el momento de la última sincronización buena (0 = nunca).
+    Al arrancar se rellena con la instantánea en disco, si la hay, para servir sin esperar a Sheets."""
+    esp = {"lock": threading.RLock(), "cabecera": [], "filas": [], "registros": [], "version": 0, "sync": 0.0, "indices": {},
+           "guardado": 0.0, "desde_instantanea": False, "refrescando": False, "caducado": False, "error": None,
+           "proximo_intento": 0.0, "fallos": 0, "ttl": None, "incremental": False, "acceso": 0.0,
+           "compartida": 0, "consulta_compartida": 0.0, "completa": 0.0}
+    inst = cargar_instantanea(nombre_hoja)
+    if inst:
+        esp["cabecera"], esp["filas"], esp["sync"] = inst
+        esp["registros"] = [a_registro(esp["cabecera"], f) for f in esp["filas"]]
+        esp["version"], esp["desde_instantanea"] = 1, True
+    registro_espejos()[nombre_hoja] = esp
+    return esp
+
+def recortar_fila(fila):
+    """Quita las celdas vacías del final para comparar filas leídas en rangos distintos"""
+    fila = list(fila)
+    while fila and fila[-1] == "": fila.pop()
+    return fila
+
+def filas_iguales(a, b):
+    """Compara filas crudas sin tener en cuenta las celdas vacías del final (get_all_values rellena, get_values no)"""
+    return len(a) == len(b) and (a == b or all(recortar_fila(x) == recortar_fila(y) for x, y in zip(a, b)))
+
+def a_registro(cabecera, fila):
+    fila = list(fila) + [""] * (len(cabecera) - len(fila))
+    return dict(zip(cabecera, fila))
+
+def leer_novedades(esp, nombre_hoja, incremental, prioritaria=False):
+    """Parte de red de la sincronización, fuera del lock. En modo incremental lee desde la última fila
+    ingerida hasta el final; si esa fila de anclaje ya no coincide (borrado, menos filas o edición de la
+    última), o no hay nada cargado, lee la hoja entera. El ancla no ve ediciones de filas anteriores
+    (p. ej. una hora retocada a mano en Sheets), así que cada RECONCILIACION_COMPLETA segundos se lee
+    la hoja entera igualmente y aplicar_novedades la compara con el espejo."""
+    with esp["lock"]:
+        n, cabecera = len(esp["filas"]), esp["cabecera"]
+        ancla = esp["filas"][-1] if n else cabecera
+        reconciliar = time.time() - esp["completa"] >= RECONCILIACION_COMPLETA
+    if incremental and cabecera and not reconciliar:
+        col_final = gspread.utils.rowcol_to_a1(1, len(cabecera))[:-1]
+        rango = f"A{n + 1}:{col_final}"
+        leidas = ejecutar_en_hoja(nombre_hoja, lambda sheet: sheet.get_values(rango), prioritaria=prioritaria, clave=rango)
+        if leidas and recortar_fila(leidas[0]) == recortar_fila(ancla):
+            return {"modo": "cola", "desde": n, "filas": leidas[1:]}
+    valores = ejecutar_en_hoja(nombre_hoja, lambda sheet: sheet.get_all_values(), prioritaria=prioritaria, clave="completa")
+    return {"modo": "completa", "cabecera": valores[0] if valores else [], "filas": valores[1:]}
+
+def aplicar_novedades(esp, nombre_hoja, novedades):
+    """Parte local, con el lock. Devuelve False si el espejo cambió entre la lectura y ahora (se reintentará).
+    Lo leído de Sheets se publica en la caché compartida, ya sin el lock y solo si trajo algo nuevo (o esta
+    réplica aún no había publicado nada); lo que viene de ella lleva su momento de sincronización."""
+    with esp["lock"]:
+        if novedades["modo"] == "completa" and "compartida" not in novedades:
+            esp["completa"] = time.time()
+            if novedades["cabecera"] == esp["cabecera"] and filas_iguales(esp["filas"], novedades["filas"]):
+                # Reconciliación sin diferencias: nada que rehacer (ni índices ni versión)
+                contar("espejo.reconciliacion_igual")
+                novedades = {"modo": "cola", "desde": len(esp["filas"]), "filas": []}
+            elif esp["filas"]: contar("espejo.reconciliacion_distinta")
+        if novedades["modo"] == "completa":
+            esp["cabecera"], esp["filas"] = novedades["cabecera"], novedades["filas"]
+            esp["registros"] = [a_registro(esp["cabecera"], f) for f in esp["filas"]]
+            esp["version"] += 1
+        elif len(esp["filas"]) != novedades["desde"]:
+            return False
+        elif novedades["filas"]:
+            esp["filas"].extend(novedades["filas"])
+            # Lista nueva en vez de extend: las sesiones que ya tienen la anterior no la ven cambiar a mitad de uso
+            nuevos = [a_registro(esp["cabecera"], f) for f in novedades["filas"]]
+            esp["registros"] = esp["registros"] + nuevos
+            anadir_a_indices(esp, nuevos)
+        esp["sync"], esp["desde_instantanea"], esp["caducado"] = novedades.get("sincronizado") or time.time(), False, False
+        esp["error"], esp["fallos"] = None, 0
+        publicacion = None
+        if "compartida" in novedades: esp["compartida"] = novedades["compartida"]
+        elif novedades["modo"] == "completa" or not esp["compartida"]: publicacion = datos_publicacion(esp)
+        else: publicacion = datos_publicacion(esp, novedades["desde"], cambios=bool(novedades["filas"]))
+        programar_instantanea(esp, nombre_hoja)
+    publicar_en_compartida(esp, nombre_hoja, publicacion)
+    return True
+
+def refrescar_en_segundo_plano(esp, nombre_hoja):
+    """Pone al día el espejo sin bloquear a nadie: mientras tanto se sigue sirviendo la última copia buena.
+    Si falla, la copia se conserva, se anota el error y se espera cada vez más antes de reintentar."""
+    with esp["lock"]:
+        if esp["refrescando"] or time.time() < esp["proximo_intento"]: return
+        esp["refrescando"] = True
+    def tarea():
+        try:
+            with medir(f"espejo.refresco:{nombre_hoja}"):
+                # Primero lo que otra réplica ya haya leído; si no hay nada y otra está leyendo, se espera a que publique
+                novedades = leer_compartida(esp, nombre_hoja)
+                if novedades is None and not reservar_refresco(nombre_hoja):
+                    contar("compartida.turno_ocupado")
+                    esp["proximo_intento"] = time.time() + INTERVALO_COMPARTIDA
+                    return
+                if not aplicar_novedades(esp, nombre_hoja, novedades or leer_novedades(esp, nombre_hoja, esp["incremental"])):
+                    esp["caducado"] = True
+        except Exception as e:
+            contar("espejo.refresco_fallido")
+            esp["error"], esp["fallos"] = f"{e}", esp["fallos"] + 1
+            esp["proximo_intento"] = time.time() + min(2 ** esp["fallos"], 60)
+        finally: esp["refrescando"] = False
+    threading.Thread(target=tarea, daemon=True, name=f"refrescar-{nombre_hoja}").start()
+
+def sincronizar_espejo(nombre_hoja, ttl, incremental=False):
+    esp = espejo_hoja(nombre_hoja)
+    esp["ttl"], esp["incremental"], esp["acceso"] = ttl, incremental, time.time()
+    # Tras una escritura propia (caducado) se lee de Sheets: lo publicado por otra réplica podría no incluirla
+    if not esp["caducado"]: consultar_compartida(esp, nombre_hoja, forzar=not esp["sync"])
+    if esp["sync"] and not esp["caducado"]:
+        # Stale-while-revalidate: siempre se sirve la última copia buena; si caducó (o viene de la
+        # instantánea de arranque) se refresca en segundo plano
+        if esp["desde_instantanea"] or time.time() - esp["sync"] >= ttl:
+            contar("espejo.obsoleto")
+            refrescar_en_segundo_plano(esp, nombre_hoja)
+        else: contar("espejo.fresco")
+        return esp
+    # Sin copia buena (primera carga del proceso) o caducada a propósito tras una escritura: se espera
+    with medir(f"espejo.espera:{nombre_hoja}"), esp["lock"]:
+        if esp["sync"] and not esp["caducado"]: return esp
+        contar("espejo.bloqueante")
+        # Los reintentos con espera los hace el planificador
+        try:
+            aplicar_novedades(esp, nombre_hoja, leer_novedades(esp, nombre_hoja, incremental))
+        except Exception as e:
+            if isinstance(e, gspread.exceptions.WorksheetNotFound) and hoja_opcional(nombre_hoja):
+                # El manifiesto antes del primer archivado o una partición borrada a mano: se trata como vacía
+                esp["sync"], esp["caducado"] = time.time(), False
+            else:
+                # Sin copia buena se queda sin sincronizar ('sync' a 0) y la próxima lectura lo vuelve a intentar
+                esp["error"] = f"{e}"
+                if not esp["sync"]: st.error(f"⚠️ Error de conexión con Google Sheets ({nombre_hoja}): {e}")
+    return esp
+
+def caducar_espejo(nombre_hoja):
+    """Fuerza una sincronización en la próxima lectura (tras reescribir la hoja)"""
+    espejo_hoja(nombre_hoja)["caducado"] = True
+
+def espejo_disponible(nombre_hoja):
+    """True si hay una copia buena que servir (aunque sea antigua)"""
+    return bool(espejo_hoja(nombre_hoja)["sync"])
+
+@st.cache_resource
+def refresco_anticipado():
+    """Hilo que refresca cada espejo en uso poco antes de que caduque, para que ninguna petición pague la descarga.
+    Los que nadie ha leído en tres TTL se dejan caducar."""
+    registro = registro_espejos()
+    def bucle():
+        while True:
+            time.sleep(5)
+            ahora = time.time()
+            for nombre_hoja, esp in list(registro.items()):
+                ttl = esp["ttl"]
+                if not ttl or not esp["sync"] or ahora - esp["acceso"] > 3 * ttl: continue
+                if ahora - esp["sync"] >= ttl * ANTICIPO_REFRESCO: refrescar_en_segundo_plano(esp, nombre_hoja)
+    threading.Thread(target=bucle, daemon=True, name="refresco-anticipado").start()
+    return registro
+
+def formatear_edad(segundos):
+    if segundos < 60: return "menos de 1 min"
+    if segundos < 3600: return f"{int(segundos // 60)} min"
+    return f"{int(segundos // 3600)} h {int((segundos % 3600) // 60)} min"
+
+def aviso_frescura(nombre_hoja):
+    """Edad de la copia servida y, si el último refresco falló, aviso de que se muestran datos antiguos"""
+    esp = espejo_hoja(nombre_hoja)
+    if not esp["sync"]: return
+    edad = formatear_edad(time.time() - esp["sync"])
+    if esp["error"]: st.warning(f"⚠️ No se pudo actualizar '{nombre_hoja}' desde Google Sheets. Se muestran datos de hace {edad}.")
+    else: st.caption(f"🕒 '{nombre_hoja}' actualizada hace {edad}.")
+
+def aplicar_escritura(nombre_hoja, filas, respuesta):
+    """Write-through: aplica al espejo de esa hoja las filas recién añadidas y sube solo su versión.
+    Si no quedaron justo detrás de la última fila ingerida (otra sesión escribió antes), se lee la cola."""
+    esp = espejo_hoja(nombre_hoja)
+    m = re.search(r"![A-Z]+(\d+)", ((respuesta or {}).get("updates") or {}).get("updatedRange", ""))
+    with esp["lock"]:
+        if m and esp["cabecera"] and int(m.group(1)) == len(esp["filas"]) + 2:
+            filas, desde = [[str(v) for v in f] for f in filas], len(esp["filas"])
+            esp["filas"].extend(filas)
+            nuevos = [a_registro(esp["cabecera"], f) for f in filas]
+            esp["registros"] = esp["registros"] + nuevos
+            anadir_a_indices(esp, nuevos)
+            publicacion = datos_publicacion(esp, desde)
+        else:
+            esp["caducado"] = True
+            return
+    publicar_en_compartida(esp, nombre_hoja, publicacion)
+
+@medido("escritura.filas")
+def escribir_filas(nombre_hoja, filas):
+    respuesta = ejecutar_en_hoja(nombre_hoja, lambda sheet: sheet.append_rows(filas), escritura=True)
+    aplicar_escritura(nombre_hoja, filas, respuesta)
+    return respuesta
+
+def instantanea_espejo(nombre_hoja, ttl):
+    """Registros y copia de las filas crudas de la misma versión, para editar y detectar conflictos al guardar"""
+    esp = sincronizar_espejo(nombre_hoja, ttl)
+    with esp["lock"]:
+        return esp["registros"], list(esp["filas"])
+
+# --- INSTANTÁNEAS EN DISCO (ARRANQUE EN FRÍO) ---
+# Cada espejo se guarda como Parquet para que, tras un reinicio, se sirva al momento y se reconcilie con Sheets
+# en segundo plano. Las celdas se guardan con el texto exacto de la hoja: las firmas y el ancla de la cola se
+# calculan sobre ese texto ("9:05" y "09:05" son la misma hora pero no la misma firma), así que pasar fechas
+# y horas a tipos nativos no permitiría devolverlas tal cual. Las columnas llevan el nombre de la cabecera y
+# las repetitivas (Empleado, Tipo, Dispositivo...) van como diccionario: ocupan menos y pandas las lee como
+# categóricas. La cabecera exacta (puede tener nombres vacíos o repetidos) va además en los metadatos.
+DIR_INSTANTANEAS = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".instantaneas")
+INTERVALO_INSTANTANEA = 300
+FORMATO_INSTANTANEA = 3
+
+def ruta_instantanea(nombre_hoja):
+    return os.path.join(DIR_INSTANTANEAS, re.sub(r"\W+", "_", nombre_hoja) + ".parquet")
+
+def cargar_instantanea(nombre_hoja):
+    """(cabecera, filas, momento de su última sincronización), o None si no hay o es de otro libro u otro formato"""
+    try:
+        tabla = pq.read_table(ruta_instantanea(nombre_hoja))
+        meta = json.loads(tabla.schema.metadata[b"asistencia"])
+        if meta.get("libro") != SHEET_NAME or meta.get("formato") != FORMATO_INSTANTANEA: return None
+        columnas = [tabla.column(i).to_pylist() for i in range(tabla.num_columns)]
+        return meta["cabecera"], [list(f) for f in zip(*columnas)], meta["sincronizado"]
+    except Exception:
+        return None
+
+def columna_instantanea(valores):
+    """Texto tal cual; como diccionario si se repite mucho (empleados, tipos, dispositivos, meses...)"""
+    columna = pa.array(valores, type=pa.string())
+    return columna.dictionary_encode() if len(set(valores)) * 2 <= len(valores) else columna
+
+def guardar_instantanea(nombre_hoja, cabecera, filas, version, sincronizado):
+    ancho = max([len(cabecera)] + [len(f) for f in filas])
+    columnas = [[f[i] if i < len(f) else "" for f in filas] for i in range(ancho)]
+    nombres = [str(cabecera[i]).strip() if i < len(cabecera) else "" for i in range(ancho)]
+    nombres = [n if n and nombres.count(n) == 1 and not re.fullmatch(r"c\d+", n) else f"c{i}" for i, n in enumerate(nombres)]
+    meta = {"libro": SHEET_NAME, "formato": FORMATO_INSTANTANEA, "hoja": nombre_hoja, "cabecera": cabecera,
+            "version": version, "filas": len(filas), "sincronizado": sincronizado, "guardado": obtener_ahora().isoformat()}
+    tabla = pa.table({n: columna_instantanea(c) for n, c in zip(nombres, columnas)},
+                     metadata={"asistencia": json.dumps(meta, ensure_ascii=False)})
+    os.makedirs(DIR_INSTANTANEAS, exist_ok=True)
+    ruta = ruta_instantanea(nombre_hoja)
+    pq.write_table(tabla, ruta + ".tmp")
+    os.replace(ruta + ".tmp", ruta) # Nunca queda una instantánea a medio escribir
+
+def programar_instantanea(esp, nombre_hoja):
+    """Como mucho una escritura cada INTERVALO_INSTANTANEA segundos por hoja, en un hilo aparte"""
+    if time.time() - esp["guardado"] < INTERVALO_INSTANTANEA: return
+    esp["guardado"] = time.time()
+    args = (nombre_hoja, list(esp["cabecera"]), list(esp["filas"]), esp["version"], esp["sync"])
+    threading.Thread(target=lambda: guardar_instantanea(*args), daemon=True, name=f"instantanea-{nombre_hoja}").start()
+
+# --- CACHÉ COMPARTIDA ENTRE RÉPLICAS (OPCIONAL) ---
+# Con varias réplicas detrás de un balanceador cada una leería las hojas por su cuenta. Si se configura
+# 'cache_compartida' (ruta de un SQLite en un volumen común), la réplica que lee de Sheets o escribe publica
+# allí las filas y sube la versión de la hoja; las demás la comparan cada INTERVALO_COMPARTIDA segundos y,
+# si cambió, copian solo lo nuevo a su espejo (sus índices avanzan igual que con la cola de la hoja).
+# Un turno con caducidad evita que todas las réplicas refresquen la misma hoja a la vez.
+INTERVALO_COMPARTIDA = 2
+TURNO_COMPARTIDA = 30
+ESQUEMA_COMPARTIDA = """
+CREATE TABLE IF NOT EXISTS hojas (libro TEXT, hoja TEXT, version INTEGER, sincronizado REAL, cabecera TEXT,
+                                  filas INTEGER, turno REAL DEFAULT 0, PRIMARY KEY (libro, hoja));
+CREATE TABLE IF NOT EXISTS filas (libro TEXT, hoja TEXT, n INTEGER, fila TEXT, PRIMARY KEY (libro, hoja, n)) WITHOUT ROWID;
+"""
+
+@st.cache_resource
+def cache_compartida():
+    """Una conexión por hilo (sqlite3 no comparte conexiones entre hilos); None si no está configurada"""
+    return {"local": threading.local()} if CACHE_COMPARTIDA else None
+
+def conexion_compartida():
+    cc = cache_compartida()
+    if cc is None: return None
+    con = getattr(cc["local"], "con", None)
+    if con is None:
+        con = sqlite3.connect(CACHE_COMPARTIDA, timeout=10, isolation_level=None)
+        con.execute("PRAGMA journal_mode=WAL") # Lectores sin bloquear al que publica
+        con.execute("PRAGMA synchronous=NORMAL")
+        con.executescript(ESQUEMA_COMPARTIDA)
+        cc["local"].con = con
+    return con
+
+@contextmanager
+def transaccion(con, inmediata=False):
+    con.execute("BEGIN IMMEDIATE" if inmediata else "BEGIN")
+    try: yield con
+    except BaseException:
+        con.execute("ROLLBACK")
+        raise
+    con.execute("COMMIT")
+
+def leer_compartida(esp, nombre_hoja):
+    """Novedades publicadas por otra réplica que este espejo aún no tiene, con el formato de leer_novedades,
+    o None. Si la fila de anclaje coincide solo se traen las filas nuevas."""
+    con = conexion_compartida()
+    if con is None: return None
+    with esp["lock"]:
+        n, cabecera, compartida, sync = len(esp["filas"]), esp["cabecera"], esp["compartida"], esp["sync"]
+        ancla = esp["filas"][-1] if n else None
+    clave = (SHEET_NAME, nombre_hoja)
+    try:
+        with medir("compartida.leer"), transaccion(con): # Metadatos y filas de la misma versión
+            meta = con.execute("SELECT version, sincronizado, cabecera, filas FROM hojas WHERE libro=? AND hoja=?", clave).fetchone()
+            if meta is None or meta[0] == compartida or meta[1] < sync: return None
+            version, sincronizado, cab, total = meta
+            base = {"sincronizado": sincronizado, "compartida": version}
+            if n and total >= n and json.loads(cab) == cabecera:
+                fila = con.execute("SELECT fila FROM filas WHERE libro=? AND hoja=? AND n=?", clave + (n - 1,)).fetchone()
+                if fila and json.loads(fila[0]) == ancla:
+                    filas = con.execute("SELECT fila FROM filas WHERE libro=? AND hoja=? AND n>=? ORDER BY n", clave + (n,))
+                    return {"modo": "cola", "desde": n, "filas": [json.loads(f) for f, in filas], **base}
+            filas = con.execute("SELECT fila FROM filas WHERE libro=? AND hoja=? ORDER BY n", clave)
+            return {"modo": "completa", "cabecera": json.loads(cab), "filas": [json.loads(f) for f, in filas], **base}
+    except sqlite3.Error: # La caché es un atajo: si falla se sigue con Sheets
+        contar("compartida.error")
+        return None
+
+def datos_publicacion(esp, desde=None, cambios=True):
+    """Con el lock del espejo: lo que publicar_en_compartida escribirá después sin él. Basta con la lista de
+    filas y su longitud de ahora, porque 'filas' solo crece por el final o se sustituye entera.
+    'desde' es la primera fila nueva si solo se añadieron; None para publicar la hoja entera."""
+    return {"cabecera": esp["cabecera"], "filas": esp["filas"], "n": len(esp["filas"]), "desde": desde,
+            "sync": esp["sync"], "cambios": cambios}
+
+def publicar_en_compartida(esp, nombre_hoja, publicacion):
+    """Sin el lock del espejo, tras leer de Sheets o escribir: sube las filas a la caché compartida y su versión.
+    Si la copia compartida acaba justo donde empiezan las filas nuevas (mismo número de filas y misma fila de
+    anclaje) solo se insertan esas; si ya las tiene (otra publicación llegó antes) no se toca; si no, se
+    reemplaza entera, porque lo que acaba de leerse es lo último. Sin cambios solo se libera el turno de
+    refresco: subir la versión haría que las demás réplicas volvieran a leer sin motivo."""
+    con = conexion_compartida()
+    if con is None or publicacion is None: return
+    clave, filas, n, desde = (SHEET_NAME, nombre_hoja), publicacion["filas"], publicacion["n"], publicacion["desde"]
+    cabecera = json.dumps(publicacion["cabecera"], ensure_ascii=False)
+    def ancla_coincide(i):
+        """La fila i (desde 0) es la misma en la caché compartida y en lo que se publica"""
+        if i < 0: return True
+        f = con.execute("SELECT fila FROM filas WHERE libro=? AND hoja=? AND n=?", clave + (i,)).fetchone()
+        return f is not None and recortar_fila(json.loads(f[0])) == recortar_fila(filas[i])
+    try:
+        if not publicacion["cambios"]:
+            con.execute("UPDATE hojas SET turno=0 WHERE libro=? AND hoja=?", clave)
+            return
+        with medir("compartida.publicar"), transaccion(con, inmediata=True):
+            meta = con.execute("SELECT version, filas, cabecera FROM hojas WHERE libro=? AND hoja=?", clave).fetchone()
+            misma_cabecera = desde is not None and meta is not None and meta[2] == cabecera
+            if misma_cabecera and meta[1] >= n and ancla_coincide(n - 1):
+                con.execute("UPDATE hojas SET turno=0 WHERE libro=? AND hoja=?", clave)
+                return
+            if not (misma_cabecera and meta[1] == desde and ancla_coincide(desde - 1)):
+                con.execute("DELETE FROM filas WHERE libro=? AND hoja=?", clave)
+                desde = 0
+            con.executemany("INSERT INTO filas VALUES (?, ?, ?, ?)", (clave + (i, json.dumps(filas[i], ensure_ascii=False))
+                                                                   for i in range(desde, n)))
+            version = (meta[0] if meta else 0) + 1
+            # Publicar libera el turno de refresco
+            con.execute("INSERT OR REPLACE INTO hojas VALUES (?, ?, ?, ?, ?, ?, 0)",
+                        clave + (version, publicacion["sync"], cabecera, n))
+        esp["compartida"] = version
+        contar("compartida.publicada")
+    except sqlite3.Error:
+        contar("compartida.error")
+
+def reservar_refresco(nombre_hoja):
+    """True si a esta réplica le toca leer la hoja de Sheets: nadie tiene el turno o ha vencido"""
+    con = conexion_compartida()
+    if con is None: return True
+    clave, ahora = (SHEET_NAME, nombre_hoja), time.time()
+    try:
+        if con.execute("UPDATE hojas SET turno=? WHERE libro=? AND hoja=? AND turno<?", (ahora + TURNO_COMPARTIDA,) + clave + (ahora,)).rowcount:
+            return True
+        return con.execute("SELECT 1 FROM hojas WHERE libro=? AND hoja=?", clave).fetchone() is None
+    except sqlite3.Error:
+        contar("compartida.error")
+        return True
+
+def consultar_compartida(esp, nombre_hoja, forzar=False):
+    """Trae lo publicado por otras réplicas; sin 'forzar', como mucho cada INTERVALO_COMPARTIDA segundos"""
+    if cache_compartida() is None: return
+    if not forzar and time.time() - esp["consulta_compartida"] < INTERVALO_COMPARTIDA: return
+    esp["consulta_compartida"] = time.time()
+    novedades = leer_compartida(esp, nombre_hoja)
+    if novedades and aplicar_novedades(esp, nombre_hoja, novedades): contar("compartida.adoptada")
+
+# --- GUARDADO POR DIFERENCIAS (TABLAS EDITABLES) ---
+def valor_celda(v):
+    try:
+        if pd.isna(v): return ""
+    except (TypeError, ValueError): pass
+    return str(v)
+
+def diferencias_tabla(df_original, df_editado, columnas):
+    """Compara por índice; el índice del original es la posición del registro en el espejo (fila de hoja = índice + 2).
+    Devuelve (cambiadas {fila: valores}, borradas [filas de mayor a menor], nuevas [valores])."""
+    def por_indice(df):
+        return {i: [valor_celda(v) for v in fila] for i, fila in zip(df.index, df.reindex(columns=columnas).values.tolist())}
+    orig, edit = por_indice(df_original), por_indice(df_editado)
+    cambiadas = {i + 2: v for i, v in edit.items() if i in orig and v != orig[i]}
+    borradas = sorted((i + 2 for i in orig if i not in edit), reverse=True)
+    nuevas = [v for i, v in edit.items() if i not in orig and any(v)]
+    return cambiadas, borradas, nuevas
+
+def peticiones_borrado(sheet_id, filas):
+    """deleteDimension de abajo arriba (cada borrado no desplaza los siguientes), con las filas consecutivas
+    unidas en un solo rango: un mes archivado son unos pocos rangos, no una petición por fila"""
+    peticiones = []
+    for n in sorted(set(filas), reverse=True):
+        rango = peticiones[-1]["deleteDimension"]["range"] if peticiones else None
+        if rango and rango["startIndex"] == n: rango["startIndex"] = n - 1
+        else: peticiones.append({"deleteDimension": {"range": {"sheetId": sheet_id, "dimension": "ROWS", "startIndex": n - 1, "endIndex": n}}})
+    return peticiones
+
+@medido("escritura.diferencias")
+def guardar_diferencias(nombre_hoja, df_original, df_editado, filas_base):
+    """Aplica solo lo que cambió: un batch_update para las celdas, una petición con todos los borrados
+    y un append_rows para las altas. Devuelve False sin escribir nada si la hoja ya no es la que se cargó."""
+    columnas = list(df_original.columns)
+    cambiadas, borradas, nuevas = diferencias_tabla(df_original, df_editado, columnas)
+    col_final = gspread.utils.rowcol_to_a1(1, len(columnas))[:-1]
+    
+    if not (cambiadas or borradas or nuevas): return True
+    actuales = ejecutar_en_hoja(nombre_hoja, lambda sheet: sheet.get_values(f"A2:{col_final}"))
+    if [recortar_fila(f) for f in actuales] != [recortar_fila(f) for f in filas_base]:
+        caducar_espejo(nombre_hoja)
+        return False
+    # Una llamada por paso: si una devuelve 429 y se reintenta, no se repiten las que ya se aplicaron
+    if cambiadas:
+        ejecutar_en_hoja(nombre_hoja, lambda sheet: sheet.batch_update(
+            [{"range": f"A{r}:{col_final}{r}", "values": [v]} for r, v in cambiadas.items()]), escritura=True)
+    if borradas:
+        ejecutar_en_hoja(nombre_hoja, lambda sheet: sheet.spreadsheet.batch_update(
+            {"requests": peticiones_borrado(sheet.id, borradas)}), escritura=True)
+    if nuevas: ejecutar_en_hoja(nombre_hoja, lambda sheet: sheet.append_rows(nuevas), escritura=True)
+    caducar_espejo(nombre_hoja)
+    return True
+
+def indice_espejo(esp, clave, construir, anadir=None):
+    """Estructura derivada de la hoja: se construye una vez por versión del espejo y la comparten todas las sesiones.
+    Si se da 'anadir(datos, registro)', las filas nuevas de la cola se aplican sobre ella sin reconstruirla."""
+    with esp["lock"]:
+        ind = esp["indices"].get(clave)
+        if ind is None or ind["version"] != esp["version"]:
+            contar("indice.construido")
+            with medir(f"indice.construir:{clave}"): ind = {"version": esp["version"], "datos": construir(esp["registros"])}
+            esp["indices"][clave] = ind
+        else: contar("indice.reutilizado")
+        ind["anadir"] = anadir
+        return ind["datos"]
+
+def anadir_a_indices(esp, nuevos):
+    """Sube la versión del espejo tras añadir filas y lleva consigo los índices incrementales al día"""
+    for ind in esp["indices"].values():
+        if ind.get("anadir") and ind["version"] == esp["version"]:
+            for r in nuevos: ind["anadir"](ind["datos"], r)
+            ind["version"] += 1
+            contar("indice.incremental")
+    esp["version"] += 1
+
+# --- FUNCIONES DE LECTURA ---
+def construir_indice_usuarios(registros):
+    por_token = {}
+    for r in registros:
+        token = str(r.get('ID', '')).strip()
+        if token: por_token.setdefault(token, r)
+    return {"por_token": por_token, "nombres": [r.get('Nombre') for r in registros]}
+
+@medido("carga.usuarios")
 def cargar_datos_usuarios():
-    return leer_con_reintento("Usuarios")
+    return sincronizar_espejo("Usuarios", TTL_MAESTROS)["registros"]
 
-@st.cache_data(ttl=600)
+def indice_usuarios():
+    """token -> registro y lista de nombres para los selectores"""
+    return indice_espejo(sincronizar_espejo("Usuarios", TTL_MAESTROS), "usuarios", construir_indice_usuarios)
+
+def construir_indice_calendario(registros):
+    """fecha -> {"global": motivo (solo si es festivo), "individual": {empleado: motivo}}"""
+    ind = {}
+    for r in registros:
+        try: dia = datetime.strptime(str(r.get('Fecha', '')).strip(), "%d/%m/%Y").date()
+        except ValueError: continue
+        ent = ind.setdefault(dia, {"individual": {}})
+        if r.get('Tipo') == "GLOBAL": ent.setdefault("global", r.get('Motivo'))
+        elif r.get('Tipo') == "INDIVIDUAL": ent["individual"].setdefault(r.get('Empleado'), r.get('Motivo'))
+    return ind
+
+@medido("carga.calendario")
 def cargar_datos_calendario():
-    return leer_con_reintento("Calendario")
+    return sincronizar_espejo("Calendario", TTL_MAESTROS)["registros"]
+
+def indice_calendario():
+    return indice_espejo(sincronizar_espejo("Calendario", TTL_MAESTROS), "calendario", construir_indice_calendario)
 
-@st.cache_data(ttl=60)
+def ausencias_en_rango(desde, hasta):
+    """Días entre 'desde' y 'hasta' (incluidos) con festivo o vacaciones, p. ej. quién libra la semana que viene"""
+    ind = indice_calendario()
+    dias = (desde + timedelta(days=i) for i in range((hasta - desde).days + 1))
+    return {d: ind[d] for d in dias if d in ind}
+
+DIAS_SEMANA = ["Lun", "Mar", "Mié", "Jue", "Vie", "Sáb", "Dom"]
+
+def tabla_ausencias(desde, hasta):
+    """Una fila por festivo o día libre de un empleado entre 'desde' y 'hasta'"""
+    filas = []
+    for d, ent in sorted(ausencias_en_rango(desde, hasta).items()):
+        dia = f"{DIAS_SEMANA[d.weekday()]} {d.strftime('%d/%m')}"
+        if "global" in ent: filas.append({"Día": dia, "Quién": "🏢 Todos", "Motivo": ent["global"]})
+        for emp, motivo in sorted(ent["individual"].items()): filas.append({"Día": dia, "Quién": emp, "Motivo": motivo})
+    return pd.DataFrame(filas, columns=["Día", "Quién", "Motivo"])
+
+@medido("carga.registros")
 def cargar_datos_registros():
-    return leer_con_reintento("Hoja 1")
+    """Registros de "Hoja 1" servidos desde el espejo; cada TTL_REGISTROS segundos solo se descargan las filas nuevas"""
+    return sincronizar_espejo("Hoja 1", TTL_REGISTROS, incremental=True)["registros"]
+
+# --- PARTICIONES MENSUALES (ARCHIVO) ---
+# Los meses cerrados se mueven de "Hoja 1" a una hoja por mes ("Registros AAAA-MM") y se anotan en el
+# manifiesto "Particiones". "Hoja 1" queda como partición viva: el mes en curso y lo aún no archivado.
+HOJA_PARTICIONES = "Particiones"
+CABECERA_PARTICIONES = ["Mes", "Hoja", "Filas", "Archivado"]
+
+def clave_mes(mes):
+    return mes[3:], mes[:2]
+
+def mes_de_fecha(fecha):
+    try: return datetime.strptime(str(fecha).strip(), "%d/%m/%Y").strftime("%m/%Y")
+    except ValueError: return None
+
+def hoja_opcional(nombre_hoja):
+    """Hojas que pueden no existir sin que sea un error: el manifiesto y las particiones mensuales"""
+    return nombre_hoja == HOJA_PARTICIONES or nombre_hoja.startswith("Registros ")
+
+def cargar_datos_hoja(nombre_hoja):
+    return sincronizar_espejo(nombre_hoja, TTL_MAESTROS)["registros"]
+
+@medido("carga.manifiesto")
+def cargar_manifiesto():
+    """Mes (MM/AAAA) -> nombre de la hoja con sus fichajes archivados"""
+    registros = cargar_datos_hoja(HOJA_PARTICIONES)
+    return {r.get('Mes'): r.get('Hoja') for r in registros if r.get('Mes') and r.get('Hoja')}
+
+def construir_meses(registros):
+    return {m for m in (mes_de_fecha(r.get('Fecha')) for r in registros) if m}
+
+def anadir_mes(meses, r):
+    m = mes_de_fecha(r.get('Fecha'))
+    if m: meses.add(m)
+
+def meses_vivos():
+    """Meses que siguen en "Hoja 1" (índice incremental, no recorre el registro en cada recarga)"""
+    esp = sincronizar_espejo("Hoja 1", TTL_REGISTROS, incremental=True)
+    return indice_espejo(esp, "meses", construir_meses, anadir_mes)
+
+def hojas_para_mes(mes, particiones):
+    """Poda de particiones: solo se leen las hojas que pueden tener fichajes del mes pedido.
+    "Hoja 1" siempre entra, porque una corrección manual de un mes archivado se añade allí."""
+    if mes == "Todos": return sorted(particiones.values()) + ["Hoja 1"]
+    return ([particiones[mes]] if mes in particiones else []) + ["Hoja 1"]
+
+def marco_verificado(nombre_hoja):
+    """Marco tipado de una hoja con su estado de firma en 'Estado' y su versión. La copia que supone
+    añadir la columna se hace una vez por versión del espejo, no en cada recarga."""
+    esp = espejo_hoja(nombre_hoja)
+    with esp["lock"]: # Marco y estados de la misma versión
+        _, estados, v = registros_verificados(nombre_hoja)
+        df, _ = marco_fichajes(nombre_hoja)
+        return indice_espejo(esp, "verificado", lambda registros: df.assign(Estado=pd.Categorical(estados))), v
+
+def construir_vista(marcos):
+    """Hojas unidas, sin fichajes sin fecha u hora y del más reciente al más antiguo"""
+    return unir_marcos(marcos).dropna(subset=['Fecha', 'Hora']).sort_values(by='DT', ascending=False)
+
+@medido("carga.registros_de_mes")
+def registros_de_mes(mes, particiones):
+    """Marco tipado de las hojas que pueden tener fichajes del mes, con su estado de firma en 'Estado' y
+    ordenado del fichaje más reciente al más antiguo, y la versión de datos de cada hoja.
+    Como el agregado de horas, se guarda en el espejo de "Hoja 1" y se rehace solo al cambiar alguna versión."""
+    hojas = hojas_para_mes(mes, particiones)
+    archivadas = [marco_verificado(h) for h in hojas if h != "Hoja 1"]
+    versiones = tuple(v for _, v in archivadas)
+    esp = sincronizar_espejo("Hoja 1", TTL_REGISTROS, incremental=True)
+    with esp["lock"]:
+        viva, v = marco_verificado("Hoja 1")
+        marcos = [df for df, _ in archivadas] + [viva]
+        vista = indice_espejo(esp, "vista:" + "|".join(hojas), lambda registros: {"versiones": versiones, "df": construir_vista(marcos)})
+        if vista["versiones"] != versiones: vista.update(versiones=versiones, df=construir_vista(marcos))
+        return vista["df"], versiones + (v,)
+
+def abrir_o_crear_hoja(nombre_hoja, cabecera):
+    if conectar_google_sheets(nombre_hoja) is None:
+        ejecutar_en_hoja("Hoja 1", lambda s: s.spreadsheet.add_worksheet(title=nombre_hoja, rows=100, cols=len(cabecera)), escritura=True)
+        invalidar_conexion(nombre_hoja)
+        ejecutar_en_hoja(nombre_hoja, lambda s: s.append_row(cabecera), escritura=True)
+
+@st.cache_resource
+def lock_archivado():
+    return threading.Lock()
+
+@medido("escritura.archivo")
+def archivar_meses_cerrados():
+    """Mueve a su partición los fichajes de meses anteriores al actual. Las filas se copian tal cual, así que
+    las firmas siguen verificando. Si se corta a medias se puede repetir: no duplica lo ya copiado.
+    Devuelve {mes: filas movidas}."""
+    lock = lock_archivado()
+    if not lock.acquire(blocking=False): raise RuntimeError("Ya hay un archivado en curso. Espera a que termine.")
+    try: return archivar_meses(obtener_ahora())
+    finally: lock.release()
+
+def archivar_meses(hoy):
+    valores = ejecutar_en_hoja("Hoja 1", lambda sheet: sheet.get_all_values())
+    if len(valores) < 2: return {}
+    cabecera, por_mes, ultimo = valores[0], {}, {}
+    for n, fila in enumerate(valores[1:], start=2):
+        try: d = datetime.strptime(str(fila[0]).strip(), "%d/%m/%Y")
+        except (ValueError, IndexError): continue
+        if (d.year, d.month) < (hoy.year, hoy.month):
+            por_mes.setdefault(d.strftime("%m/%Y"), []).append((n, fila))
+            r = a_registro(cabecera, fila)
+            try: dt = datetime.strptime(f"{r.get('Fecha')} {r.get('Hora')}", '%d/%m/%Y %H:%M:%S')
+            except ValueError: dt = d
+            if r.get('Empleado') not in ultimo or dt >= ultimo[r.get('Empleado')][0]: ultimo[r.get('Empleado')] = (dt, n, r.get('Tipo'))
+    # La última ENTRADA de un empleado sin SALIDA detrás se queda en "Hoja 1": el estado de fichaje solo
+    # lee "Hoja 1" y, archivada, el empleado pasaría a FUERA. Se archiva cuando tenga fichajes posteriores en un mes cerrado.
+    abiertas = {n for _, n, tipo in ultimo.values() if tipo == "ENTRADA"}
+    por_mes = {mes: [(n, f) for n, f in filas if n not in abiertas] for mes, filas in por_mes.items()}
+    por_mes = {mes: filas for mes, filas in por_mes.items() if filas}
+    if not por_mes: return {}
+    
+    abrir_o_crear_hoja(HOJA_PARTICIONES, CABECERA_PARTICIONES)
+    manifiesto = ejecutar_en_hoja(HOJA_PARTICIONES, lambda s: s.get_all_values())
+    filas_manifiesto = {f[0]: i for i, f in enumerate(manifiesto[1:], start=2) if f}
+    for mes, filas in sorted(por_mes.items(), key=lambda x: clave_mes(x[0])):
+        nombre_hoja = f"Registros {mes[3:]}-{mes[:2]}"
+        abrir_o_crear_hoja(nombre_hoja, cabecera)
+        existentes = {tuple(recortar_fila(f)) for f in ejecutar_en_hoja(nombre_hoja, lambda s: s.get_all_values())[1:]}
+        nuevas = [f for _, f in filas if tuple(recortar_fila(f)) not in existentes]
+        if nuevas: ejecutar_en_hoja(nombre_hoja, lambda s: s.append_rows(nuevas), escritura=True)
+        entrada = [mes, nombre_hoja, len(existentes) + len(nuevas), hoy.strftime("%d/%m/%Y %H:%M:%S")]
+        if mes in filas_manifiesto:
+            fila = filas_manifiesto[mes]
+            ejecutar_en_hoja(HOJA_PARTICIONES, lambda s: s.update(range_name=f"A{fila}:D{fila}", values=[entrada]), escritura=True)
+        else: ejecutar_en_hoja(HOJA_PARTICIONES, lambda s: s.append_row(entrada), escritura=True)
+        caducar_espejo(nombre_hoja)
+    
+    # Antes de borrar se comprueba que cada fila sigue en su sitio: si otro archivado (otra réplica u otro
+    # administrador) ya borró, las filas se habrán movido y se borraría lo que no toca. Lo copiado no se duplica al repetir.
+    actuales = ejecutar_en_hoja("Hoja 1", lambda sheet: sheet.get_all_values())
+    movidas = [(n, fila) for filas in por_mes.values() for n, fila in filas]
+    if any(n > len(actuales) or recortar_fila(actuales[n - 1]) != recortar_fila(fila) for n, fila in movidas):
+        caducar_espejo("Hoja 1")
+        raise RuntimeError("'Hoja 1' ha cambiado durante el archivado (¿otro archivado a la vez?). No se ha borrado nada; "
+                           "vuelve a intentarlo, lo ya copiado no se duplica.")
+    # Borrado en una sola petición; lo que se añada mientras tanto va al final y no se mueve
+    ejecutar_en_hoja("Hoja 1", lambda sheet: sheet.spreadsheet.batch_update(
+        {"requests": peticiones_borrado(sheet.id, [n for n, _ in movidas])}), escritura=True)
+    caducar_espejo("Hoja 1")
+    caducar_espejo(HOJA_PARTICIONES)
+    return {mes: len(filas) for mes, filas in por_mes.items()}
+
+# --- COLA DE FICHAJES (WRITE-BEHIND) ---
+# Pulsar ENTRADA/SALIDA solo anota la fila en un diario local; un hilo la vuelca después en
+# "Hoja 1" por lotes con append_rows, en orden y reintentando con espera exponencial.
+RUTA_COLA = os.path.join(os.path.dirname(os.path.abspath(__file__)), "cola_fichajes.jsonl")
+LOTE_COLA = 200
+VENTANA_DUPLICADOS = 5000
+
+def anotar_en_diario(entradas, truncar=False):
+    with open(RUTA_COLA, "w" if truncar else "a", encoding="utf-8") as fh:
+        for e in entradas: fh.write(json.dumps(e, ensure_ascii=False) + "\n")
+        fh.flush()
+        os.fsync(fh.fileno())
+
+@st.cache_resource
+def cola_fichajes():
+    """Pendientes (id -> fila, en orden de llegada) recuperados del diario y el hilo que los vuelca"""
+    cola = {"lock": threading.Lock(), "pendientes": {}, "hay_trabajo": threading.Event(), "error": None}
+    if os.path.exists(RUTA_COLA):
+        with open(RUTA_COLA, encoding="utf-8") as fh:
+            for linea in fh:
+                try: e = json.loads(linea)
+                except ValueError: continue # Línea a medio escribir por una caída
+                if "ok" in e: cola["pendientes"].pop(e["ok"], None)
+                else: cola["pendientes"][e["id"]] = e["fila"]
+    # Tras un reinicio no sabemos si el último lote llegó a la hoja: se comprueba antes de reenviar
+    cola["dudoso"] = bool(cola["pendientes"])
+    threading.Thread(target=volcar_cola, args=(cola,), daemon=True, name="volcado-fichajes").start()
+    cola["hay_trabajo"].set()
+    return cola
+
+@medido("escritura.encolar")
+def encolar_fichajes(filas):
+    cola = cola_fichajes()
+    entradas = [{"id": str(uuid.uuid4()), "fila": f} for f in filas]
+    with cola["lock"]:
+        anotar_en_diario(entradas)
+        for e in entradas: cola["pendientes"][e["id"]] = e["fila"]
+    cola["hay_trabajo"].set()
+
+def fichajes_pendientes(nombre=None):
+    cola = cola_fichajes()
+    with cola["lock"]:
+        filas = list(cola["pendientes"].values())
+    return [a_registro(COLUMNAS_FIRMA, f) for f in filas if nombre is None or f[2] == nombre]
+
+def confirmar_en_diario(cola, ids):
+    with cola["lock"]:
+        for i in ids: cola["pendientes"].pop(i, None)
+        if cola["pendientes"]: anotar_en_diario([{"ok": i} for i in ids])
+        else: anotar_en_diario([], truncar=True)
+
+def descartar_ya_escritas(lote):
+    """Tras un fallo dudoso (la petición pudo llegar), se lee la cola de la hoja y se quitan del
+    lote las filas que ya están escritas. Cada fichaje lleva su firma, así que no hay falsos positivos."""
+    esp = espejo_hoja("Hoja 1")
+    # La lectura va sin el lock (con Sheets caído puede tardar todos los reintentos y el estado de cada
+    # empleado se sirve del espejo mientras tanto); si otra sesión movió el espejo entre medias, se repite
+    while not aplicar_novedades(esp, "Hoja 1", leer_novedades(esp, "Hoja 1", True, prioritaria=True)): pass
+    with esp["lock"]:
+        recientes = {tuple(recortar_fila(f)) for f in esp["filas"][-VENTANA_DUPLICADOS:]}
+    escritas = [i for i, f in lote if tuple(recortar_fila([str(v) for v in f])) in recientes]
+    return escritas, [(i, f) for i, f in lote if i not in escritas]
+
+def volcar_cola(cola):
+    espera = 1
+    while True:
+        cola["hay_trabajo"].wait(timeout=30)
+        cola["hay_trabajo"].clear()
+        while True:
+            with cola["lock"]:
+                lote = list(cola["pendientes"].items())[:LOTE_COLA]
+            if not lote: break
+            try:
+                if cola["dudoso"]:
+                    escritas, lote = descartar_ya_escritas(lote)
+                    if escritas: confirmar_en_diario(cola, escritas)
+                    cola["dudoso"] = False
+                if lote:
+                    filas = [f for _, f in lote]
+                    with medir("cola.volcado"):
+                        respuesta = ejecutar_en_hoja("Hoja 1", lambda sheet: sheet.append_rows(filas), escritura=True, prioritaria=True)
+                        aplicar_escritura("Hoja 1", filas, respuesta)
+                        confirmar_en_diario(cola, [i for i, _ in lote])
+                    contar("cola.filas_volcadas", len(filas))
+                cola["error"], espera = None, 1
+            except Exception as e:
+                contar("cola.volcado_fallido")
+                cola["error"], cola["dudoso"] = f"{e}", True
+                time.sleep(espera + random.uniform(0, espera / 2))
+                espera = min(espera * 2, 60)
 
 # --- FUNCIONES LÓGICAS ---
 def generar_firma(fecha, hora, nombre, tipo, dispositivo):
@@ -100,64 +1105,242 @@ def verificar_integridad(row):
         return "✅ OK" if firma == calc else "⚠️ MANIPULADO"
     except: return "❓ ERROR"
 
+# --- VERIFICACIÓN DE FIRMAS (MEMOIZADA) ---
+# Una fila firmada no cambia, así que su resultado se guarda por contenido: tras una recarga
+# completa solo se vuelven a calcular las filas nuevas o editadas.
+COLUMNAS_FIRMA = ('Fecha', 'Hora', 'Empleado', 'Tipo', 'Dispositivo', 'Firma')
+
+@st.cache_resource
+def memo_firmas(nombre_hoja):
+    """Un memo por hoja: cada hoja solo olvida sus filas, y se usa siempre con el lock de su espejo"""
+    return {}
+
+def estado_integridad(memo, r):
+    clave = tuple(r.get(c) for c in COLUMNAS_FIRMA)
+    est = memo.get(clave)
+    if est is None:
+        est = memo[clave] = verificar_integridad(r)
+    return est
+
+def construir_integridad(memo, registros):
+    estados = [estado_integridad(memo, r) for r in registros]
+    # Se olvidan las filas que ya no están en la hoja (editadas o borradas)
+    vigentes = {tuple(r.get(c) for c in COLUMNAS_FIRMA) for r in registros}
+    for clave in [c for c in memo if c not in vigentes]: del memo[clave]
+    return estados
+
+def anadir_integridad(memo, estados, r):
+    estados.append(estado_integridad(memo, r))
+
+@medido("auditoria.verificacion")
+def registros_verificados(nombre_hoja="Hoja 1"):
+    """Registros de una hoja de fichajes, su estado de firma (alineados) y la versión de datos a la que
+    corresponden. La lista de estados hace de marca 'verificado hasta la fila N': las filas nuevas de la
+    cola se verifican al llegar, una a una."""
+    ttl = TTL_REGISTROS if nombre_hoja == "Hoja 1" else TTL_PARTICIONES
+    esp = sincronizar_espejo(nombre_hoja, ttl, incremental=True)
+    with esp["lock"]:
+        memo = memo_firmas(nombre_hoja)
+        estados = indice_espejo(esp, "integridad", lambda registros: construir_integridad(memo, registros),
+                                lambda estados, r: anadir_integridad(memo, estados, r))
+        return esp["registros"], estados[:len(esp["registros"])], esp["version"]
+
+# --- MARCO TIPADO DE FICHAJES ---
+# Los fichajes se parsean una vez por hoja y versión del espejo, no en cada recarga: texto repetido como
+# categoría (cada user-agent se guarda una sola vez), DT como datetime64 y el mes ya calculado.
+# El marco se comparte entre sesiones y es de solo lectura: filtrar o añadir columnas (copy-on-write)
+# no lo modifica; asignar sobre él sí, y eso no se hace.
+COLUMNAS_MARCO = ['Fecha', 'Hora', 'Empleado', 'Tipo', 'Dispositivo']
+
+def tipar_fichajes(registros):
+    """DataFrame con las filas en el orden de los registros. Fecha y Hora se parsean por valor distinto, no por fila."""
+    df = pd.DataFrame.from_records(registros, columns=COLUMNAS_MARCO).astype("category")
+    fecha, hora = df['Fecha'].cat, df['Hora'].cat
+    dias = pd.DatetimeIndex(pd.to_datetime(fecha.categories, format='%d/%m/%Y', errors='coerce'))
+    horas = pd.DatetimeIndex(pd.to_datetime(hora.categories, format='%H:%M:%S', errors='coerce'))
+    # El código -1 (celda vacía) cae en el NaT que se añade al final
+    dias_np = np.append(dias.to_numpy(), np.datetime64('NaT'))
+    horas_np = np.append((horas - horas.normalize()).to_numpy(), np.timedelta64('NaT'))
+    cf, ch = fecha.codes.to_numpy(), hora.codes.to_numpy()
+    df['DT'] = dias_np[cf] + horas_np[ch]
+    df['Mes'] = pd.Categorical(np.append(dias.strftime('%m/%Y').to_numpy(dtype=object), None)[cf])
+    return df
+
+def unir_marcos(marcos):
+    """Concatena marcos tipados sin perder las categorías (pd.concat las pasaría a texto si no coinciden)"""
+    marcos = [m for m in marcos if len(m)] or marcos[:1]
+    if len(marcos) == 1: return marcos[0]
+    columnas = {}
+    for c in marcos[0].columns:
+        if isinstance(marcos[0][c].dtype, pd.CategoricalDtype):
+            try: columnas[c] = pd.api.types.union_categoricals([m[c] for m in marcos])
+            except TypeError: # Categorías de distinto tipo (p. ej. una columna vacía en una hoja)
+                columnas[c] = pd.Categorical(pd.concat([m[c].astype(object) for m in marcos], ignore_index=True))
+        else: columnas[c] = pd.concat([m[c] for m in marcos], ignore_index=True)
+    return pd.DataFrame(columnas)
+
+def construir_marco(registros):
+    return {"df": tipar_fichajes(registros), "pendientes": []}
+
+def anadir_a_marco(marco, r):
+    marco["pendientes"].append(r) # Se tipan todas juntas al pedir el marco
+
+def marco_de_espejo(esp):
+    with esp["lock"]:
+        marco = indice_espejo(esp, "marco", construir_marco, anadir_a_marco)
+        if marco["pendientes"]:
+            marco["df"] = unir_marcos([marco["df"], tipar_fichajes(marco["pendientes"])])
+            marco["pendientes"] = []
+        return marco["df"]
+
+@medido("carga.marco")
+def marco_fichajes(nombre_hoja="Hoja 1"):
+    """Marco tipado de una hoja de fichajes y la versión de datos a la que corresponde"""
+    ttl = TTL_REGISTROS if nombre_hoja == "Hoja 1" else TTL_PARTICIONES
+    esp = sincronizar_espejo(nombre_hoja, ttl, incremental=True)
+    with esp["lock"]:
+        return marco_de_espejo(esp), esp["version"]
+
 def obtener_nombre_por_token(token):
-    records = cargar_datos_usuarios()
-    token_s = str(token).strip()
-    for r in records:
-        if str(r.get('ID')).strip() == token_s: return r.get('Nombre')
-    return None
+    r = indice_usuarios()["por_token"].get(str(token).strip())
+    return r.get('Nombre') if r else None
 
-def obtener_estado_actual(nombre):
-    data = cargar_datos_registros()
-    if not data: return "FUERA", None
+def enlace_acceso(token):
+    return f"{APP_URL}/?token={token}"
+
+# --- ALTA MASIVA DE EMPLEADOS ---
+def leer_nombres_csv(contenido):
+    """Nombres de un CSV de altas: la columna 'Nombre' si la hay; si no, la primera columna (sin cabecera)"""
+    # Excel en Windows guarda los CSV en cp1252 ("Muñoz" no es UTF-8 válido); latin-1 decodifica cualquier byte
+    for codificacion in ("utf-8-sig", "cp1252", "latin-1"):
+        try:
+            texto = contenido.decode(codificacion)
+            break
+        except UnicodeDecodeError: continue
+    try: dialecto = csv.Sniffer().sniff(texto[:4096], delimiters=",;\t")
+    except csv.Error: dialecto = csv.excel # Una sola columna: no hay separador que adivinar
+    filas = [f for f in csv.reader(io.StringIO(texto), dialecto) if any(c.strip() for c in f)]
+    if not filas: return []
+    cabecera = [c.strip().casefold() for c in filas[0]]
+    if "nombre" in cabecera:
+        col = cabecera.index("nombre")
+        return [f[col] for f in filas[1:] if len(f) > col]
+    return [f[0] for f in filas]
+
+def preparar_altas(nombres, existentes):
+    """(nuevos, descartados): sin vacíos ni repetidos, ni dentro del fichero ni con los que ya existen"""
+    vistos = {" ".join(str(n).split()).casefold() for n in existentes if n}
+    nuevos, descartados = [], []
+    for n in nombres:
+        n = " ".join(n.split())
+        if not n: continue
+        if n.casefold() in vistos: descartados.append(n)
+        else:
+            vistos.add(n.casefold())
+            nuevos.append(n)
+    return nuevos, descartados
+
+@medido("escritura.alta_masiva")
+def alta_masiva(nombres):
+    """Todas las altas en una sola escritura; devuelve nombre y enlace de acceso de cada una"""
+    filas = [[str(uuid.uuid4()), n] for n in nombres]
+    escribir_filas("Usuarios", filas)
+    return pd.DataFrame({"Nombre": nombres, "Enlace de Acceso": [enlace_acceso(uid) for uid, _ in filas]})
+
+# --- ÍNDICE DE ESTADO POR EMPLEADO ---
+# empleado -> {"ultimo": (dt, tipo, hora) del último fichaje ya pasado,
+#              "pendientes": fichajes futuros ordenados (p. ej. auto-salidas programadas)}
+def construir_indice_estado(df):
+    """A partir del marco tipado de "Hoja 1" """
+    ind = {}
+    df = df.dropna(subset=['DT']).sort_values(by='DT', kind='stable')
     
-    df = pd.DataFrame(data)
-    if 'Empleado' not in df.columns: return "FUERA", None
+    # IGNORAR FUTURO (queda como pendiente hasta que llegue su hora)
+    ahora_naive = obtener_ahora().replace(tzinfo=None)
+    pasados = df[df['DT'] <= ahora_naive].groupby('Empleado', sort=False, observed=True).tail(1)
+    for emp, dt, tipo, hora in zip(pasados['Empleado'], pasados['DT'], pasados['Tipo'], pasados['Hora']):
+        ind[emp] = {"ultimo": (dt.to_pydatetime(), tipo, hora), "pendientes": []}
+    futuros = df[df['DT'] > ahora_naive]
+    for emp, dt, tipo, hora in zip(futuros['Empleado'], futuros['DT'], futuros['Tipo'], futuros['Hora']):
+        ind.setdefault(emp, {"ultimo": None, "pendientes": []})["pendientes"].append((dt.to_pydatetime(), tipo, hora))
+    return ind
+
+def anadir_a_estado(ind, r):
+    try: dt = datetime.strptime(f"{r.get('Fecha')} {r.get('Hora')}", '%d/%m/%Y %H:%M:%S')
+    except ValueError: return
+    emp, ev = r.get('Empleado'), (dt, r.get('Tipo'), r.get('Hora'))
+    ent = ind.get(emp, {"ultimo": None, "pendientes": []})
+    if dt > obtener_ahora().replace(tzinfo=None):
+        ind[emp] = {"ultimo": ent["ultimo"], "pendientes": sorted(ent["pendientes"] + [ev], key=lambda e: e[0])}
+    elif ent["ultimo"] is None or dt >= ent["ultimo"][0]:
+        ind[emp] = {"ultimo": ev, "pendientes": ent["pendientes"]}
+
+def indice_estado():
+    esp = sincronizar_espejo("Hoja 1", TTL_REGISTROS, incremental=True)
+    return indice_espejo(esp, "estado", lambda registros: construir_indice_estado(marco_de_espejo(esp)), anadir_a_estado)
+
+@medido("logica.estado")
+def obtener_estado_actual(nombre):
+    ind = indice_estado()
     
-    df_emp = df[df['Empleado'] == nombre]
-    if df_emp.empty: return "FUERA", None
+    # Fichajes aún en la cola: cuentan ya para el estado aunque no estén confirmados en la hoja
+    en_cola = fichajes_pendientes(nombre)
+    if en_cola:
+        ind = {nombre: ind.get(nombre) or {"ultimo": None, "pendientes": []}}
+        for r in en_cola: anadir_a_estado(ind, r)
     
-    df_emp = df_emp.dropna(subset=['Fecha', 'Hora'])
-    df_emp['DT'] = pd.to_datetime(df_emp['Fecha'] + ' ' + df_emp['Hora'], format='%d/%m/%Y %H:%M:%S', errors='coerce')
+    ent = ind.get(nombre)
+    if not ent: return "FUERA", None
     
-    # IGNORAR FUTURO
+    # Los pendientes cuya hora ya ha llegado cuentan como último fichaje. No se escribe de vuelta en el
+    # índice compartido: anadir_a_estado lo actualiza con el lock del espejo y podría perderse un fichaje.
+    # Son pocos (las auto-salidas programadas) y se recalculan en cada consulta.
     ahora_naive = obtener_ahora().replace(tzinfo=None)
-    df_emp = df_emp[df_emp['DT'] <= ahora_naive]
-    
-    df_emp = df_emp.sort_values(by='DT')
-    
-    if df_emp.empty: return "FUERA", None
+    ultimo, pendientes = ent["ultimo"], ent["pendientes"]
+    while pendientes and pendientes[0][0] <= ahora_naive:
+        if ultimo is None or pendientes[0][0] >= ultimo[0]: ultimo = pendientes[0]
+        pendientes = pendientes[1:]
     
-    ultimo = df_emp.iloc[-1]
-    return ("DENTRO", ultimo['Hora']) if ultimo['Tipo'] == "ENTRADA" else ("FUERA", None)
+    if ultimo is None: return "FUERA", None
+    return ("DENTRO", ultimo[2]) if ultimo[1] == "ENTRADA" else ("FUERA", None)
 
+@medido("logica.puede_fichar")
 def puede_fichar_hoy(nombre):
-    data = cargar_datos_calendario()
-    hoy = obtener_ahora().strftime("%d/%m/%Y")
-    for r in data:
-        if r.get('Fecha') == hoy:
-            if r.get('Tipo') == "GLOBAL": return False, f"Festivo: {r.get('Motivo')}"
-            if r.get('Tipo') == "INDIVIDUAL" and r.get('Empleado') == nombre: return False, f"Vacaciones: {r.get('Motivo')}"
+    ent = indice_calendario().get(obtener_ahora().date())
+    if ent:
+        if "global" in ent: return False, f"Festivo: {ent['global']}"
+        if nombre in ent["individual"]: return False, f"Vacaciones: {ent['individual'][nombre]}"
     return True, "OK"
 
-def registrar_fichaje(nombre, tipo, disp):
+def registrar_fichaje(nombre, tipo, disp, salida_auto=None):
+    """Anota el fichaje (y la salida automática, si se pide) en la cola y vuelve enseguida"""
     try:
-        sheet = conectar_google_sheets("Hoja 1")
-        if not sheet: st.error("Error conectando a Hoja 1"); return
-
         ahora = obtener_ahora()
         f, h = ahora.strftime("%d/%m/%Y"), ahora.strftime("%H:%M:%S")
         
-        firma = generar_firma(f, h, nombre, tipo, disp)
-        sheet.append_row([f, h, nombre, tipo, disp, firma])
+        filas = []
+        if salida_auto:
+            h_auto = salida_auto.strftime("%H:%M:%S")
+            disp_auto = f"{disp} (Auto-Programada)"
+            filas.append([f, h_auto, nombre, "SALIDA", disp_auto, generar_firma(f, h_auto, nombre, "SALIDA", disp_auto)])
+        filas.append([f, h, nombre, tipo, disp, generar_firma(f, h, nombre, tipo, disp)])
+        encolar_fichajes(filas)
         
-        st.cache_data.clear()
-        st.success(f"✅ {tipo} registrada correctamente a las {h}.")
-        time.sleep(2)
+        if salida_auto: st.toast(f"✅ Salida programada para las {h_auto}")
+        st.toast(f"✅ {tipo} registrada correctamente a las {h}.")
         st.rerun()
     except Exception as e:
         st.error(f"Error al guardar: {e}")
 
+def agente_de_usuario():
+    """User-agent del navegador para la firma. El sondeo JS cuesta una recarga extra, así que se hace
+    una vez por sesión y solo en la página del empleado (0 mientras el navegador no ha respondido)."""
+    if st.session_state.get("agente_usuario"): return st.session_state["agente_usuario"]
+    try: ua = importar("streamlit_javascript").st_javascript("navigator.userAgent")
+    except Exception: return "Desconocido"
+    if ua: st.session_state["agente_usuario"] = ua
+    return ua
+
 # --- HELPER: PALETA DE ALTO CONTRASTE ---
 def obtener_color_por_nombre(nombre):
     colores_contrastados = [
@@ -169,62 +1352,247 @@ def obtener_color_por_nombre(nombre):
     indice = abs(hash(nombre)) % len(colores_contrastados)
     return colores_contrastados[indice]
 
+# --- EVENTOS DEL CALENDARIO (PRECALCULADOS) ---
+# La lista de eventos de FullCalendar se arma una vez por versión del calendario. 'codigos' dice de quién
+# es cada evento (-1 = festivo), así el filtro de empleados es una máscara sobre la lista, no un recorrido.
+def construir_eventos_calendario(registros):
+    eventos, propios, codigos, empleados, dias = [], [], [], {}, {}
+    for r in registros:
+        tipo, emp, motivo = (str(r.get(c, '')).strip() for c in ('Tipo', 'Empleado', 'Motivo'))
+        fecha = str(r.get('Fecha', '')).strip()
+        if tipo not in ('GLOBAL', 'INDIVIDUAL') or not fecha: continue
+        if fecha not in dias: # Una conversión por fecha distinta
+            try: dias[fecha] = datetime.strptime(fecha, "%d/%m/%Y").strftime("%Y-%m-%d")
+            except ValueError: dias[fecha] = None
+        d_iso = dias[fecha]
+        if d_iso is None: continue
+        if tipo == 'GLOBAL': col, tit, cod = "#000000", f"🏢 {motivo}", -1
+        else: col, tit, cod = obtener_color_por_nombre(emp), emp, empleados.setdefault(emp, len(empleados))
+        ev = {"title": tit, "start": d_iso, "end": d_iso, "backgroundColor": col, "borderColor": col, "allDay": True, "textColor": "#FFFFFF"}
+        eventos.append(ev)
+        propios.append({**ev, "title": "TÚ", "backgroundColor": "#109618", "borderColor": "#109618"} if cod >= 0 else ev)
+        codigos.append(cod)
+    return {"eventos": eventos, "propios": propios, "codigos": np.array(codigos, dtype=np.int32), "empleados": empleados}
+
+def eventos_calendario():
+    """Eventos de todo el calendario, la versión "TÚ" de cada uno y empleado -> código"""
+    return indice_espejo(sincronizar_espejo("Calendario", TTL_MAESTROS), "eventos", construir_eventos_calendario)
+
+@medido("calendario.eventos")
+def construir_eventos_equipo(nombre, sel_users):
+    """Eventos del calendario de equipo: festivos para todos y días individuales de los empleados elegidos.
+    Los del propio empleado ('nombre') salen como "TÚ"; con None, todos con su color."""
+    cal = eventos_calendario()
+    codigos, elegidos = cal["codigos"], [cal["empleados"][e] for e in sel_users if e in cal["empleados"]]
+    idx = np.flatnonzero((codigos < 0) | np.isin(codigos, elegidos))
+    propio, eventos, propios = cal["empleados"].get(nombre, -2), cal["eventos"], cal["propios"]
+    return [propios[i] if c == propio else eventos[i] for i, c in zip(idx.tolist(), codigos[idx].tolist())]
+
+# --- MOTOR DE EMPAREJAMIENTO ENTRADA/SALIDA ---
+@medido("auditoria.horas")
+def emparejar_fichajes(df):
+    """Convierte fichajes (con columna DT) en sesiones de trabajo en una sola pasada por columnas.
+    Cada ENTRADA se empareja con la SALIDA inmediatamente posterior del mismo empleado.
+    Devuelve (sesiones, sueltos): sesiones con Empleado, Entrada, Salida, Duracion (s) y Dia;
+    sueltos con los fichajes que se quedan sin pareja y el motivo en 'Incidencia'."""
+    ev = df[df['Tipo'].isin(['ENTRADA', 'SALIDA'])].dropna(subset=['DT'])
+    ev = ev.sort_values(by=['Empleado', 'DT'], kind='stable')
+    por_emp = ev.groupby('Empleado', sort=False, observed=True)
+    sig_tipo, sig_dt, ant_tipo = por_emp['Tipo'].shift(-1), por_emp['DT'].shift(-1), por_emp['Tipo'].shift(1)
+    
+    abre = (ev['Tipo'] == 'ENTRADA') & (sig_tipo == 'SALIDA')
+    cierra = (ev['Tipo'] == 'SALIDA') & (ant_tipo == 'ENTRADA')
+    sesiones = pd.DataFrame({'Empleado': ev.loc[abre, 'Empleado'], 'Entrada': ev.loc[abre, 'DT'], 'Salida': sig_dt[abre]})
+    sesiones['Duracion'] = (sesiones['Salida'] - sesiones['Entrada']).dt.total_seconds()
+    sesiones['Dia'] = sesiones['Entrada'].dt.normalize()
+    
+    sueltos = ev[~(abre | cierra)].copy()
+    sueltos['Incidencia'] = sueltos['Tipo'].map({'ENTRADA': "ENTRADA sin SALIDA", 'SALIDA': "SALIDA sin ENTRADA"})
+    return sesiones.reset_index(drop=True), sueltos
+
+# --- AGREGADO DE HORAS (EMPLEADO × DÍA) ---
+# Tabla mantenida: empleado -> día -> [segundos, sesiones, fichajes sin pareja]. Una sesión cuenta en el
+# día de su ENTRADA. Se construye una vez por conjunto de hojas y versión de datos y los fichajes nuevos
+# se aplican encima: un fichaje posterior al último del empleado solo toca ese día (o el de la ENTRADA
+# que cierra); uno anterior (corrección manual) recalcula solo a ese empleado.
+# Consultar un año cuesta lo que sus días con actividad, no lo que sus fichajes.
+def datos_agregado(df):
+    """Agregado a partir de un marco tipado (una o varias hojas unidas)"""
+    sesiones, sueltos = emparejar_fichajes(df)
+    dias, ultimo, sin_pareja = {}, {}, {}
+    por_dia = sesiones.groupby(['Empleado', sesiones['Dia'].dt.date], observed=True)['Duracion'].agg(['sum', 'count'])
+    for (emp, dia), seg, n in zip(por_dia.index, por_dia['sum'], por_dia['count']):
+        dias.setdefault(emp, {})[dia] = [float(seg), int(n), 0]
+    for emp, dt, tipo in zip(sueltos['Empleado'], sueltos['DT'], sueltos['Tipo']):
+        dt = dt.to_pydatetime()
+        dias.setdefault(emp, {}).setdefault(dt.date(), [0.0, 0, 0])[2] += 1
+        sin_pareja.setdefault(emp, []).append((dt, tipo))
+    ev = df[df['Tipo'].isin(['ENTRADA', 'SALIDA'])].dropna(subset=['DT']).sort_values(by=['Empleado', 'DT'], kind='stable')
+    ult = ev.groupby('Empleado', sort=False, observed=True).tail(1)
+    for emp, dt, tipo in zip(ult['Empleado'], ult['DT'], ult['Tipo']):
+        ultimo[emp] = (dt.to_pydatetime(), tipo)
+    return {"dias": dias, "ultimo": ultimo, "sueltos": sin_pareja}
+
+def construir_agregado(marcos, versiones):
+    """versiones: las de las hojas archivadas del conjunto; si cambian (archivado) se reconstruye"""
+    return {**datos_agregado(unir_marcos(marcos)), "versiones": versiones, "pendientes": [], "tabla": None}
+
+def anadir_a_agregado(ag, r):
+    ag["pendientes"].append(r) # Se aplican al consultar, con los marcos ya al día
+
+def recalcular_empleado(ag, emp, marcos):
+    parcial = datos_agregado(unir_marcos([m[m['Empleado'] == emp] for m in marcos]))
+    for clave in ("dias", "ultimo", "sueltos"):
+        ag[clave].pop(emp, None)
+        if emp in parcial[clave]: ag[clave][emp] = parcial[clave][emp]
+
+def aplicar_fichaje(ag, r):
+    """Lleva un fichaje nuevo al agregado con las mismas reglas que emparejar_fichajes.
+    False si llega fuera de orden: cambia las parejas de ese empleado y hay que recalcularlo."""
+    tipo, emp = r.get('Tipo'), r.get('Empleado')
+    if tipo not in ('ENTRADA', 'SALIDA'): return True
+    try: dt = datetime.strptime(f"{r.get('Fecha')} {r.get('Hora')}", '%d/%m/%Y %H:%M:%S')
+    except ValueError: return True
+    previo = ag["ultimo"].get(emp)
+    if previo and dt < previo[0]: return False
+    dias = ag["dias"].setdefault(emp, {})
+    if tipo == 'SALIDA' and previo and previo[1] == 'ENTRADA':
+        # Cierra la última ENTRADA, que hasta ahora contaba como suelta
+        ent = dias[previo[0].date()]
+        ent[0] += (dt - previo[0]).total_seconds()
+        ent[1] += 1
+        ent[2] -= 1
+        ag["sueltos"][emp].pop()
+    else:
+        dias.setdefault(dt.date(), [0.0, 0, 0])[2] += 1
+        ag["sueltos"].setdefault(emp, []).append((dt, tipo))
+    ag["ultimo"][emp] = (dt, tipo)
+    return True
+
+def tablas_agregado(ag):
+    """(horas, sueltos) como DataFrames; se rehacen solo si el agregado ha cambiado"""
+    if ag["tabla"] is None:
+        horas = pd.DataFrame([(emp, dia, *v) for emp, dias in ag["dias"].items() for dia, v in dias.items()],
+                             columns=['Empleado', 'Dia', 'Segundos', 'Sesiones', 'Sueltos'])
+        horas['Dia'] = pd.to_datetime(horas['Dia'])
+        # Mes como categoría: se formatea una vez por mes distinto, no por fila
+        meses, codigos = np.unique(horas['Dia'].to_numpy().astype('datetime64[M]'), return_inverse=True)
+        horas['Mes'] = pd.Categorical.from_codes(codigos, pd.DatetimeIndex(meses).strftime('%m/%Y'))
+        sueltos = pd.DataFrame([(emp, dt, tipo) for emp, evs in ag["sueltos"].items() for dt, tipo in evs],
+                               columns=['Empleado', 'DT', 'Tipo'])
+        # Sin fichajes sueltos (todo emparejado) la columna sale vacía y sin tipo: .dt fallaría
+        sueltos['DT'] = pd.to_datetime(sueltos['DT'])
+        sueltos = sueltos.sort_values(by='DT', ascending=False)
+        sueltos['Fecha'], sueltos['Hora'] = sueltos['DT'].dt.strftime('%d/%m/%Y'), sueltos['DT'].dt.strftime('%H:%M:%S')
+        sueltos['Mes'] = sueltos['DT'].dt.strftime('%m/%Y')
+        sueltos['Incidencia'] = sueltos['Tipo'].map({'ENTRADA': "ENTRADA sin SALIDA", 'SALIDA': "SALIDA sin ENTRADA"})
+        ag["tabla"] = (horas, sueltos)
+    return ag["tabla"]
+
+@medido("auditoria.agregado")
+def agregado_horas(mes, particiones):
+    """(horas, sueltos) de las hojas que pueden tener fichajes del mes: horas por empleado y día
+    (Empleado, Dia, Mes, Segundos, Sesiones, Sueltos) y el detalle de los fichajes sin pareja.
+    Se guarda en el espejo de "Hoja 1", que es la que recibe fichajes nuevos."""
+    hojas = hojas_para_mes(mes, particiones)
+    archivadas = [marco_fichajes(h) for h in hojas if h != "Hoja 1"]
+    versiones = tuple(v for _, v in archivadas)
+    esp = sincronizar_espejo("Hoja 1", TTL_REGISTROS, incremental=True)
+    with esp["lock"]:
+        marcos = [df for df, _ in archivadas] + [marco_de_espejo(esp)]
+        ag = indice_espejo(esp, "horas:" + "|".join(hojas), lambda registros: construir_agregado(marcos, versiones), anadir_a_agregado)
+        if ag["versiones"] != versiones: ag.update(construir_agregado(marcos, versiones))
+        if ag["pendientes"]:
+            # El marco ya incluye todas las pendientes: un empleado recalculado no vuelve a sumar las suyas
+            rehacer = set()
+            for r in ag["pendientes"]:
+                if r.get('Empleado') not in rehacer and not aplicar_fichaje(ag, r): rehacer.add(r.get('Empleado'))
+            for emp in rehacer: recalcular_empleado(ag, emp, marcos)
+            contar("agregado.recalculo", len(rehacer))
+            ag["pendientes"], ag["tabla"] = [], None
+        return tablas_agregado(ag)
+
+def formatear_horas(segundos):
+    return f"{int(segundos // 3600)}h {int((segundos % 3600) // 60)}m"
+
+# --- EXPORTACIÓN DE INFORMES ---
+FORMATOS_INFORME = {
+    "Excel (.xlsx)": ("xlsx", "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"),
+    "CSV": ("csv", "text/csv"),
+    "CSV comprimido (.csv.gz)": ("csv.gz", "application/gzip"),
+}
+FILAS_POR_BLOQUE = 50000
+
+@st.cache_data(max_entries=8, show_spinner="Generando informe...")
+@medido("auditoria.informe") # Solo cuenta cuando no estaba en caché
+def generar_informe(_df, formato, mes, empleado, version):
+    """Bytes del informe. Solo se genera al pedirlo y queda guardado por (mes, empleado, versión de datos, formato);
+    _df no entra en la clave. El Excel va fila a fila con un libro write-only y el CSV por bloques."""
+    buffer = io.BytesIO()
+    if formato == "xlsx":
+        wb = importar("openpyxl").Workbook(write_only=True)
+        ws = wb.create_sheet("Auditoria")
+        ws.append(list(_df.columns))
+        for fila in _df.itertuples(index=False, name=None): ws.append([valor_celda(v) for v in fila])
+        wb.save(buffer)
+    else:
+        destino = gzip.GzipFile(fileobj=buffer, mode="wb") if formato == "csv.gz" else buffer
+        for i in range(0, max(len(_df), 1), FILAS_POR_BLOQUE):
+            trozo = _df.iloc[i:i + FILAS_POR_BLOQUE].to_csv(index=False, header=(i == 0))
+            destino.write(trozo.encode("utf-8-sig" if i == 0 else "utf-8")) # BOM para que Excel lea bien los acentos
+        if destino is not buffer: destino.close()
+    return buffer.getvalue()
+
 # --- FUNCION DE VISUALIZACION COMUN (Para Admin e Inspección) ---
 def renderizar_auditoria(es_admin=True):
     st.header("🕵️ Auditoría y Control Horario")
-    data = cargar_datos_registros()
-    if data:
-        df = pd.DataFrame(data).dropna(subset=['Fecha', 'Hora'])
-        df['Estado'] = df.apply(verificar_integridad, axis=1)
-        df['DT'] = pd.to_datetime(df['Fecha'] + ' ' + df['Hora'], format='%d/%m/%Y %H:%M:%S', errors='coerce')
-        df = df.sort_values(by='DT', ascending=False)
-        df['Mes'] = df['DT'].dt.strftime('%m/%Y')
-        
-        c1, c2 = st.columns(2)
-        meses = ["Todos"] + sorted(df['Mes'].dropna().unique().tolist(), reverse=True)
-        f_mes = c1.selectbox("Mes:", meses)
-        emps = ["Todos"] + sorted(df['Empleado'].unique().tolist())
+    # Solo se cargan las particiones del mes elegido
+    particiones = cargar_manifiesto()
+    c1, c2 = st.columns(2)
+    meses = ["Todos"] + sorted(set(particiones) | meses_vivos(), key=clave_mes, reverse=True)
+    f_mes = c1.selectbox("Mes:", meses)
+    df, version = registros_de_mes(f_mes, particiones)
+    aviso_frescura("Hoja 1")
+    if len(df):
+        emps = ["Todos"] + sorted(df['Empleado'].dropna().unique().tolist())
         f_emp = c2.selectbox("Empleado:", emps)
         
-        df_f = df.copy()
+        df_f = df # Los filtros crean vistas nuevas; el marco compartido no se toca
         if f_mes != "Todos": df_f = df_f[df_f['Mes'] == f_mes]
         if f_emp != "Todos": df_f = df_f[df_f['Empleado'] == f_emp]
         
-        tot_s = 0
-        for e in df_f['Empleado'].unique():
-            sub = df_f[df_f['Empleado'] == e].sort_values(by='DT')
-            ent = None
-            for _, r in sub.iterrows():
-                if r['Tipo'] == 'ENTRADA': ent = r['DT']
-                elif r['Tipo'] == 'SALIDA' and ent:
-                    tot_s += (r['DT'] - ent).total_seconds()
-                    ent = None
-        st.metric("Horas Trabajadas (Selección)", f"{int(tot_s // 3600)}h {int((tot_s % 3600) // 60)}m")
+        # Las horas salen del agregado por empleado y día, no de emparejar los fichajes filtrados
+        horas, sueltos = agregado_horas(f_mes, particiones)
+        if f_mes != "Todos": horas, sueltos = horas[horas['Mes'] == f_mes], sueltos[sueltos['Mes'] == f_mes]
+        if f_emp != "Todos": horas, sueltos = horas[horas['Empleado'] == f_emp], sueltos[sueltos['Empleado'] == f_emp]
+        st.metric("Horas Trabajadas (Selección)", formatear_horas(horas['Segundos'].sum()))
+        if not sueltos.empty:
+            with st.expander(f"⚠️ {len(sueltos)} fichajes sin pareja (no cuentan en las horas)"):
+                st.dataframe(sueltos.reindex(columns=['Fecha', 'Hora', 'Empleado', 'Tipo', 'Incidencia']), use_container_width=True, hide_index=True)
         
-        t_list, t_cal = st.tabs(["📄 Lista Detallada", "📅 Calendario Horas"])
+        t_list, t_cal, t_res = st.tabs(["📄 Lista Detallada", "📅 Calendario Horas", "📊 Resumen Mensual"])
         with t_list:
             cols = ['Fecha', 'Hora', 'Empleado', 'Tipo', 'Estado', 'Dispositivo']
             st.dataframe(df_f.reindex(columns=cols), use_container_width=True)
             
             # Solo permitimos descargar Excel al Admin o Inspección (ambos en este caso)
-            buffer = io.BytesIO()
-            with pd.ExcelWriter(buffer, engine='openpyxl') as writer:
-                df_f.reindex(columns=cols).to_excel(writer, index=False)
-            st.download_button("📥 Descargar Informe Excel", buffer.getvalue(), "Reporte_Auditoria.xlsx")
+            # El informe no se genera en cada recarga: solo al pulsar "Preparar" y queda cacheado
+            c_fmt, c_prep = st.columns(2)
+            formato = c_fmt.selectbox("Formato:", list(FORMATOS_INFORME), key=f"formato_{es_admin}")
+            ext, mime = FORMATOS_INFORME[formato]
+            clave = (f_mes, f_emp, version, ext)
+            if c_prep.button("⚙️ Preparar informe", key=f"preparar_{es_admin}"):
+                st.session_state[f"informe_{es_admin}"] = clave
+            if st.session_state.get(f"informe_{es_admin}") == clave:
+                datos = generar_informe(df_f.reindex(columns=cols), ext, f_mes, f_emp, version)
+                st.download_button(f"📥 Descargar Informe ({formato})", datos, f"Reporte_Auditoria.{ext}", mime=mime)
 
         with t_cal:
             if f_emp == "Todos":
                 st.info("Selecciona un empleado para ver sus horas diarias.")
             else:
-                df_calc = df_f.sort_values(by='DT')
-                horas_dia, ent = {}, None
-                for _, r in df_calc.iterrows():
-                    if r['Tipo'] == 'ENTRADA': ent = r['DT']
-                    elif r['Tipo'] == 'SALIDA' and ent:
-                        d = (r['DT'] - ent).total_seconds()
-                        k = ent.strftime("%Y-%m-%d")
-                        horas_dia[k] = horas_dia.get(k, 0) + d
-                        ent = None
+                trabajados = horas[horas['Sesiones'] > 0]
+                horas_dia = dict(zip(trabajados['Dia'].dt.strftime("%Y-%m-%d"), trabajados['Segundos']))
                 
                 evs = []
                 for k, v in horas_dia.items():
@@ -235,22 +1603,33 @@ def renderizar_auditoria(es_admin=True):
                     evs.append({"title": f"⏱️ {h}h {m}m", "start": k, "end": k, "allDay": True, "backgroundColor": c, "borderColor": c, "textColor": "#FFF"})
                 
                 if evs:
-                    calendar(events=evs, options={
+                    importar("streamlit_calendar").calendar(events=evs, options={
                         "initialDate": datetime.now().strftime("%Y-%m-%d"),
                         "headerToolbar": {"left": "prev,next", "center": "title", "right": "dayGridMonth"},
                         "initialView": "dayGridMonth", "locale": "es", "firstDay": 1
                     }, key=f"audit_{f_emp}_{es_admin}") # Key diferente para evitar conflictos
                     st.caption("🔵 >8h | 🟠 5-8h | 🔴 <5h")
                 else: st.warning("Sin datos completos.")
+
+        with t_res:
+            if horas.empty: st.info("Sin horas en la selección.")
+            else:
+                res = horas.assign(Trabajado=horas['Sesiones'] > 0).groupby(['Mes', 'Empleado'], sort=False, observed=True).agg(
+                    Segundos=('Segundos', 'sum'), Dias=('Trabajado', 'sum'), Sesiones=('Sesiones', 'sum'), Sueltos=('Sueltos', 'sum')).reset_index()
+                # Mes más reciente primero y, dentro de cada mes, empleados por nombre
+                res = res.sort_values(by='Empleado').sort_values(by='Mes', key=lambda c: c.astype(str).map(clave_mes), ascending=False, kind='stable')
+                res['Horas'] = res['Segundos'].map(formatear_horas)
+                st.dataframe(res[['Mes', 'Empleado', 'Horas', 'Dias', 'Sesiones', 'Sueltos']].rename(columns={
+                    'Dias': 'Días trabajados', 'Sueltos': 'Fichajes sin pareja'}), use_container_width=True, hide_index=True)
     else:
         st.warning("No hay registros disponibles.")
 
 # --- INTERFAZ PRINCIPAL ---
-try:
-    ua_string = st_js.st_javascript("navigator.userAgent")
-except:
-    ua_string = "Desconocido"
-
+# Cada recarga se cronometra bajo la fase de su rama (se anota al final del script: las que cortan
+# st.rerun/st.stop no cuentan como recarga, su trabajo queda en las métricas de escritura y carga)
+inicio_recarga, fase_recarga = time.perf_counter(), "recarga.sin_token"
+peticiones_del_hilo(reiniciar=True)
+refresco_anticipado()
 params = st.query_params
 token_acceso = params.get("token", None)
 
@@ -260,6 +1639,7 @@ st.title("🛡️ Control de Asistencia")
 # 1. CASO: ACCESO INSPECCIÓN (Solo Lectura)
 # ==========================================
 if token_acceso == "INSPECCION":
+    fase_recarga = "recarga.inspeccion"
     st.sidebar.title("🔐 Inspección Laboral")
     pwd_insp = st.sidebar.text_input("Clave de Acceso", type="password")
     
@@ -277,14 +1657,16 @@ if token_acceso == "INSPECCION":
 # 2. CASO: ACCESO ADMINISTRADOR
 # ==========================================
 elif token_acceso == "ADMIN": 
+    fase_recarga = "recarga.admin"
     st.sidebar.title("🔐 Administración")
     pwd = st.sidebar.text_input("Contraseña", type="password")
     
     if pwd == ADMIN_PASSWORD:
         st.sidebar.success("Acceso Concedido")
         
-        menu = ["Generar Usuarios", "Calendario y Festivos", "🔧 Corrección de Fichajes", "Auditoría e Informes"]
+        menu = ["Generar Usuarios", "Calendario y Festivos", "🔧 Corrección de Fichajes", "Auditoría e Informes", "🗄️ Archivo Mensual", "📈 Rendimiento"]
         opcion = st.sidebar.radio("Ir a:", menu)
+        fase_recarga = f"recarga.admin:{opcion}"
         
         # --- A. USUARIOS ---
         if opcion == "Generar Usuarios":
@@ -294,23 +1676,42 @@ elif token_acceso == "ADMIN":
                 n_nombre = st.text_input("Nombre Completo")
                 if st.form_submit_button("Crear Empleado"):
                     if n_nombre:
-                        sheet = conectar_google_sheets("Usuarios")
                         uid = str(uuid.uuid4())
-                        sheet.append_row([uid, n_nombre])
-                        st.cache_data.clear()
+                        escribir_filas("Usuarios", [[uid, n_nombre]])
                         st.success(f"✅ Creado: {n_nombre}")
                         time.sleep(1)
                         st.rerun()
                     else: st.error("El nombre no puede estar vacío.")
             
+            with st.expander("📥 Alta masiva desde CSV"):
+                archivo = st.file_uploader("CSV con una columna 'Nombre' (o un nombre por línea)", type=["csv", "txt"])
+                if archivo is not None:
+                    try: nombres = leer_nombres_csv(archivo.getvalue())
+                    except csv.Error as e:
+                        st.error(f"No se pudo leer el CSV: {e}")
+                        nombres = []
+                    nuevos, descartados = preparar_altas(nombres, indice_usuarios()["nombres"])
+                    st.caption(f"{len(nuevos)} empleados nuevos · {len(descartados)} ya existentes o repetidos (se ignoran)")
+                    if descartados:
+                        st.dataframe(pd.DataFrame({"Ignorados": descartados}), use_container_width=True, hide_index=True)
+                    if nuevos and st.button(f"👥 Crear {len(nuevos)} empleados", type="primary"):
+                        st.session_state["alta_masiva"] = alta_masiva(nuevos)
+                if "alta_masiva" in st.session_state:
+                    creados = st.session_state["alta_masiva"]
+                    st.success(f"✅ Creados {len(creados)} empleados.")
+                    st.dataframe(creados, use_container_width=True, hide_index=True)
+                    st.download_button("📥 Descargar enlaces (CSV)", creados.to_csv(index=False).encode("utf-8-sig"),
+                                       "enlaces_empleados.csv", mime="text/csv")
+            
             st.write("---")
             st.subheader("📋 Directorio de Accesos")
             usuarios = cargar_datos_usuarios()
+            aviso_frescura("Usuarios")
             if usuarios:
                 df_u = pd.DataFrame(usuarios)
                 if 'ID' in df_u.columns and 'Nombre' in df_u.columns:
                     base = APP_URL
-                    df_u['Enlace de Acceso'] = df_u['ID'].apply(lambda x: f"{base}/?token={x}")
+                    df_u['Enlace de Acceso'] = df_u['ID'].map(enlace_acceso)
                     df_mostrar = df_u[['Nombre', 'Enlace de Acceso']]
                     st.dataframe(df_mostrar, column_config={
                         "Nombre": st.column_config.TextColumn("Empleado", width="medium"),
@@ -335,8 +1736,7 @@ elif token_acceso == "ADMIN":
                         tipo = st.selectbox("Tipo", ["INDIVIDUAL (Un empleado)", "GLOBAL (Empresa)"])
                         nom_emp = "TODOS"
                         if "INDIVIDUAL" in tipo:
-                            usrs = cargar_datos_usuarios()
-                            l_n = [u['Nombre'] for u in usrs] if usrs else []
+                            l_n = indice_usuarios()["nombres"]
                             nom_emp = st.selectbox("Empleado:", l_n)
                     with c4:
                         modo = st.radio("Días:", ["Todos", "Solo Fines de Semana"])
@@ -347,7 +1747,6 @@ elif token_acceso == "ADMIN":
                         else:
                             d_ini = rango_fechas[0]
                             d_fin = rango_fechas[1] if len(rango_fechas) > 1 else d_ini
-                            sheet = conectar_google_sheets("Calendario")
                             rows = []
                             t_s = "GLOBAL" if "GLOBAL" in tipo else "INDIVIDUAL"
                             delta = d_fin - d_ini
@@ -356,8 +1755,7 @@ elif token_acceso == "ADMIN":
                                 if modo == "Solo Fines de Semana" and dia.weekday() < 5: continue
                                 rows.append([dia.strftime("%d/%m/%Y"), t_s, nom_emp, motivo])
                             if rows:
-                                sheet.append_rows(rows)
-                                st.cache_data.clear()
+                                escribir_filas("Calendario", rows)
                                 st.success("Añadido.")
                                 time.sleep(1)
                                 st.rerun()
@@ -365,7 +1763,8 @@ elif token_acceso == "ADMIN":
                 st.write("---")
                 st.subheader("2. 📝 Modificar o Borrar")
                 st.info("Haz clic en una celda para editar. Selecciona fila y pulsa Supr para borrar.")
-                data = cargar_datos_calendario()
+                data, filas_base = instantanea_espejo("Calendario", TTL_MAESTROS)
+                aviso_frescura("Calendario")
                 if data:
                     df = pd.DataFrame(data)
                     if 'Fecha' in df.columns:
@@ -380,48 +1779,30 @@ elif token_acceso == "ADMIN":
                     
                     if st.button("💾 Guardar Cambios Tabla", type="primary"):
                         try:
-                            vals = [df_editado.columns.values.tolist()] + df_editado.values.tolist()
-                            sheet = conectar_google_sheets("Calendario")
-                            sheet.clear()
-                            sheet.update(vals)
-                            st.cache_data.clear()
-                            st.success("Actualizado.")
-                            time.sleep(1)
-                            st.rerun()
+                            if guardar_diferencias("Calendario", df, df_editado, filas_base):
+                                st.success("Actualizado.")
+                                time.sleep(1)
+                                st.rerun()
+                            else: st.error("⚠️ El calendario ha cambiado desde que se cargó. Recarga la página y repite los cambios.")
                         except Exception as e: st.error(e)
             
             with t_vis:
-                raw_cal = cargar_datos_calendario()
-                if raw_cal:
-                    df_c = pd.DataFrame(raw_cal)
-                    if 'Empleado' not in df_c.columns: df_c['Empleado'] = ""
-                    if 'Tipo' not in df_c.columns: df_c['Tipo'] = ""
-                    if 'Fecha' not in df_c.columns: df_c['Fecha'] = ""
-                    if 'Motivo' not in df_c.columns: df_c['Motivo'] = ""
-                    
-                    df_c = df_c[df_c['Fecha'].astype(bool)]
-                    indivs = df_c[df_c['Tipo'] == 'INDIVIDUAL']['Empleado'].unique().tolist()
-                    sel_users = st.multiselect("Filtrar Empleados:", sorted(indivs), default=sorted(indivs))
+                if cargar_datos_calendario():
+                    # Quién libra esta semana y la siguiente, sin recorrer el calendario entero
+                    lunes = obtener_ahora().date() - timedelta(days=obtener_ahora().weekday())
+                    for col, titulo, desde in zip(st.columns(2), ["Esta semana", "La semana que viene"], [lunes, lunes + timedelta(days=7)]):
+                        with col:
+                            st.markdown(f"**🗓️ {titulo}** ({desde.strftime('%d/%m')} - {(desde + timedelta(days=6)).strftime('%d/%m')})")
+                            ausencias = tabla_ausencias(desde, desde + timedelta(days=6))
+                            if ausencias.empty: st.caption("Nadie libra.")
+                            else: st.dataframe(ausencias, use_container_width=True, hide_index=True)
                     
-                    events = []
-                    for _, r in df_c.iterrows():
-                        ver, col, tit = False, "#3788d8", ""
-                        tipo_r = str(r.get('Tipo', '')).strip()
-                        emp_r = str(r.get('Empleado', '')).strip()
-                        fecha_r = str(r.get('Fecha', '')).strip()
-                        motivo_r = str(r.get('Motivo', '')).strip()
-                        
-                        if tipo_r == 'GLOBAL': ver, col, tit = True, "#000000", f"🏢 {motivo_r}"
-                        elif tipo_r == 'INDIVIDUAL' and emp_r in sel_users: ver, col, tit = True, obtener_color_por_nombre(emp_r), emp_r
-                        
-                        if ver and fecha_r:
-                            try:
-                                d_iso = datetime.strptime(fecha_r, "%d/%m/%Y").strftime("%Y-%m-%d")
-                                events.append({"title": tit, "start": d_iso, "end": d_iso, "backgroundColor": col, "borderColor": col, "allDay": True, "textColor": "#FFFFFF"})
-                            except: pass 
+                    indivs = sorted(eventos_calendario()["empleados"])
+                    sel_users = st.multiselect("Filtrar Empleados:", indivs, default=indivs)
+                    events = construir_eventos_equipo(None, sel_users)
                     
                     if events:
-                        calendar(events=events, options={
+                        importar("streamlit_calendar").calendar(events=events, options={
                             "editable": False, "height": 700, 
                             "initialDate": datetime.now().strftime("%Y-%m-%d"),
                             "headerToolbar": {"left": "today prev,next", "center": "title", "right": "dayGridMonth,listMonth"},
@@ -437,8 +1818,7 @@ elif token_acceso == "ADMIN":
             st.warning("⚠️ El registro aparecerá como 'SIN FIRMA' en la auditoría.")
             with st.form("manual_entry"):
                 col_a, col_b = st.columns(2)
-                usrs = cargar_datos_usuarios()
-                lista_n = [u['Nombre'] for u in usrs] if usrs else []
+                lista_n = indice_usuarios()["nombres"]
                 with col_a:
                     emp_manual = st.selectbox("Empleado:", lista_n)
                     fecha_manual = st.date_input("Fecha:", format="DD/MM/YYYY")
@@ -449,10 +1829,9 @@ elif token_acceso == "ADMIN":
                 
                 if st.form_submit_button("💾 Guardar"):
                     try:
-                        sheet = conectar_google_sheets("Hoja 1")
                         f_str, h_str = fecha_manual.strftime("%d/%m/%Y"), hora_manual.strftime("%H:%M:%S")
-                        sheet.append_row([f_str, h_str, emp_manual, tipo_manual, f"MANUAL (Admin) - {motivo_manual}", ""])
-                        st.cache_data.clear()
+                        fila = [f_str, h_str, emp_manual, tipo_manual, f"MANUAL (Admin) - {motivo_manual}", ""]
+                        escribir_filas("Hoja 1", [fila])
                         st.success("✅ Registro añadido.")
                         time.sleep(1)
                         st.rerun()
@@ -462,6 +1841,56 @@ elif token_acceso == "ADMIN":
         elif opcion == "Auditoría e Informes":
             renderizar_auditoria(es_admin=True)
 
+        # --- E. ARCHIVO MENSUAL ---
+        elif opcion == "🗄️ Archivo Mensual":
+            st.header("🗄️ Archivo Mensual de Fichajes")
+            st.info("Mueve los fichajes de meses cerrados a una hoja por mes. El fichaje diario y la auditoría de un mes solo leen lo que necesitan.")
+            particiones = cargar_manifiesto()
+            if particiones:
+                st.dataframe(pd.DataFrame(cargar_datos_hoja(HOJA_PARTICIONES)), use_container_width=True, hide_index=True)
+            else: st.caption("Todavía no hay meses archivados.")
+            
+            if st.button("🗄️ Archivar meses cerrados", type="primary"):
+                try:
+                    movidos = archivar_meses_cerrados()
+                    if movidos:
+                        st.success("Archivado: " + ", ".join(f"{m} ({n} filas)" for m, n in sorted(movidos.items(), key=lambda x: clave_mes(x[0]))))
+                        time.sleep(1)
+                        st.rerun()
+                    else: st.info("No hay meses cerrados pendientes de archivar.")
+                except Exception as e: st.error(e)
+
+        # --- F. RENDIMIENTO ---
+        elif opcion == "📈 Rendimiento":
+            st.header("📈 Rendimiento")
+            st.info("Tiempos y contadores de este proceso (todas las sesiones). Los percentiles son de las últimas "
+                    f"{MUESTRAS_METRICA} medidas de cada operación. 'cuota.espera' alto o 'sheets.429' indican cuota "
+                    "de Google agotada; 'indice.construir', 'auditoria.*' o 'logica.*' altos, trabajo de pandas.")
+            res = resumen_metricas()
+            st.caption(f"Desde {res['desde']}")
+            cnt = res["contadores"]
+            llamadas = {f["metrica"]: f for f in res["tiempos"]}
+            aciertos = cnt.get("espejo.fresco", 0) + cnt.get("espejo.obsoleto", 0)
+            total_espejo = aciertos + cnt.get("espejo.bloqueante", 0)
+            c1, c2, c3, c4 = st.columns(4)
+            c1.metric("Lecturas / escrituras a Sheets", f"{llamadas.get('sheets.lectura', {}).get('llamadas', 0)} / {llamadas.get('sheets.escritura', {}).get('llamadas', 0)}")
+            c2.metric("Rechazos por cuota (429)", sum(n for k, n in cnt.items() if k.startswith("sheets.429")))
+            c3.metric("Lecturas servidas del espejo", f"{aciertos / total_espejo:.0%}" if total_espejo else "—")
+            c4.metric("Fichajes en cola", len(fichajes_pendientes()))
+            
+            st.subheader("⏱️ Tiempos (ms)")
+            if res["tiempos"]: st.dataframe(pd.DataFrame(res["tiempos"]), use_container_width=True, hide_index=True)
+            else: st.caption("Aún no hay medidas.")
+            st.subheader("🔢 Contadores")
+            if cnt: st.dataframe(pd.DataFrame(list(cnt.items()), columns=["evento", "total"]), use_container_width=True, hide_index=True)
+            
+            d1, d2, d3 = st.columns(3)
+            d1.download_button("📥 Prometheus (.txt)", metricas_prometheus(res), "metricas_asistencia.txt", mime="text/plain")
+            d2.download_button("📥 JSON", json.dumps(res, ensure_ascii=False, indent=2), "metricas_asistencia.json", mime="application/json")
+            if d3.button("🔄 Reiniciar métricas"):
+                reiniciar_metricas()
+                st.rerun()
+
     elif pwd:
         st.error("⛔ Contraseña incorrecta")
 
@@ -469,11 +1898,14 @@ elif token_acceso == "ADMIN":
 # 3. CASO: ACCESO EMPLEADO (Token UUID)
 # ==========================================
 elif token_acceso:
+    fase_recarga = "recarga.empleado"
     nombre = obtener_nombre_por_token(token_acceso)
     
     if nombre:
+        ua_string = agente_de_usuario()
         st.info(f"👋 Hola, **{nombre}**")
-        tab_fichar, tab_mis_vacaciones = st.tabs(["🕒 Fichar", "📅 Calendario de Equipo"])
+        # Solo se ejecuta la pestaña abierta: fichar no arma ni importa el calendario de equipo
+        tab_fichar, tab_mis_vacaciones = st.tabs(["🕒 Fichar", "📅 Calendario de Equipo"], key="pestana_empleado", on_change="rerun")
         
         with tab_fichar:
             ok, motivo = puede_fichar_hoy(nombre)
@@ -482,6 +1914,11 @@ elif token_acceso:
                 st.warning(f"Motivo: **{motivo}**")
             else:
                 estado, hora_entrada = obtener_estado_actual(nombre)
+                if not espejo_disponible("Hoja 1"):
+                    # Sin ninguna copia de los fichajes no se sabe si estás dentro o fuera: mejor no ofrecer botones
+                    st.error("⚠️ No se pueden cargar tus fichajes ahora mismo. Vuelve a intentarlo en unos minutos.")
+                    estado = None
+                else: aviso_frescura("Hoja 1")
                 st.write("---")
                 
                 if estado == "FUERA":
@@ -492,19 +1929,7 @@ elif token_acceso:
                             hora_auto = st.time_input("Hora de Salida prevista:", value=datetime_time(17, 0))
                     
                     if st.button("🟢 ENTRADA", use_container_width=True): 
-                        if usar_auto:
-                            try:
-                                sheet = conectar_google_sheets("Hoja 1")
-                                ahora = obtener_ahora()
-                                f_str = ahora.strftime("%d/%m/%Y")
-                                h_str = hora_auto.strftime("%H:%M:%S")
-                                disp_auto = f"{ua_string} (Auto-Programada)"
-                                firma = generar_firma(f_str, h_str, nombre, "SALIDA", disp_auto)
-                                sheet.append_row([f_str, h_str, nombre, "SALIDA", disp_auto, firma])
-                                st.toast(f"✅ Salida programada para las {h_str}")
-                            except Exception as e: st.error(f"Error al programar salida: {e}")
-
-                        registrar_fichaje(nombre, "ENTRADA", ua_string)
+                        registrar_fichaje(nombre, "ENTRADA", ua_string, hora_auto if usar_auto else None)
 
                 elif estado == "DENTRO":
                     h_c = hora_entrada[:5] if hora_entrada else ""
@@ -513,53 +1938,32 @@ elif token_acceso:
                     
                     if st.button("🔴 SALIDA (Manual)", use_container_width=True): 
                         registrar_fichaje(nombre, "SALIDA", ua_string)
+                
+                if fichajes_pendientes(nombre):
+                    st.caption("⏳ Fichaje guardado, pendiente de confirmar en Google Sheets.")
+                    if cola_fichajes()["error"]: st.caption("🔁 Google Sheets no responde ahora mismo; se reintentará automáticamente.")
+                else: st.caption("✅ Todos tus fichajes están confirmados.")
 
         with tab_mis_vacaciones:
-            st.write("") 
-            raw_cal = cargar_datos_calendario()
-            if raw_cal:
-                df_c = pd.DataFrame(raw_cal)
-                if 'Empleado' not in df_c.columns: df_c['Empleado'] = ""
-                if 'Tipo' not in df_c.columns: df_c['Tipo'] = ""
-                if 'Fecha' not in df_c.columns: df_c['Fecha'] = ""
-                if 'Motivo' not in df_c.columns: df_c['Motivo'] = ""
-                
-                df_c = df_c[df_c['Fecha'].astype(bool)]
-                indivs = df_c[df_c['Tipo'] == 'INDIVIDUAL']['Empleado'].unique().tolist()
-                sel_users = st.multiselect("Filtrar:", sorted(indivs), default=sorted(indivs))
-                
-                events = []
-                for _, r in df_c.iterrows():
-                    ver, col, tit = False, "#3788d8", ""
-                    tipo_r = str(r.get('Tipo', '')).strip()
-                    emp_r = str(r.get('Empleado', '')).strip()
-                    fecha_r = str(r.get('Fecha', '')).strip()
-                    motivo_r = str(r.get('Motivo', '')).strip()
+            if tab_mis_vacaciones.open:
+                st.write("") 
+                if cargar_datos_calendario():
+                    indivs = sorted(eventos_calendario()["empleados"])
+                    sel_users = st.multiselect("Filtrar:", indivs, default=indivs)
                     
-                    if tipo_r == 'GLOBAL': ver, col, tit = True, "#000000", f"🏢 {motivo_r}"
-                    elif tipo_r == 'INDIVIDUAL':
-                        if emp_r in sel_users:
-                            ver = True
-                            if emp_r == nombre: col, tit = "#109618", "TÚ"
-                            else: col, tit = obtener_color_por_nombre(emp_r), emp_r
+                    events = construir_eventos_equipo(nombre, sel_users)
                     
-                    if ver and fecha_r:
-                        try:
-                            d_iso = datetime.strptime(fecha_r, "%d/%m/%Y").strftime("%Y-%m-%d")
-                            events.append({"title": tit, "start": d_iso, "end": d_iso, "backgroundColor": col, "borderColor": col, "allDay": True, "textColor": "#FFFFFF"})
-                        except: pass
-                
-                if events:
-                    calendar(events=events, options={
-                        "editable": False, "height": 650, 
-                        "initialDate": datetime.now().strftime("%Y-%m-%d"),
-                        "headerToolbar": {"left": "today prev,next", "center": "title", "right": "dayGridMonth,listMonth"},
-                        "initialView": "dayGridMonth", "locale": "es", "firstDay": 1,
-                        "buttonText": {"today": "Hoy", "month": "Mes", "list": "Lista"}
-                    }, key=f"cal_user_{len(events)}_{len(sel_users)}")
-                    st.caption("🏢 Festivos | 🟢 Tus Días | 🎨 Compañeros")
-                else: st.info("No hay eventos.")
-            else: st.warning("Calendario vacío.")
+                    if events:
+                        importar("streamlit_calendar").calendar(events=events, options={
+                            "editable": False, "height": 650, 
+                            "initialDate": datetime.now().strftime("%Y-%m-%d"),
+                            "headerToolbar": {"left": "today prev,next", "center": "title", "right": "dayGridMonth,listMonth"},
+                            "initialView": "dayGridMonth", "locale": "es", "firstDay": 1,
+                            "buttonText": {"today": "Hoy", "month": "Mes", "list": "Lista"}
+                        }, key=f"cal_user_{len(events)}_{len(sel_users)}")
+                        st.caption("🏢 Festivos | 🟢 Tus Días | 🎨 Compañeros")
+                    else: st.info("No hay eventos.")
+                else: st.warning("Calendario vacío.")
     else:
         st.error("⛔ Token inválido.")
 
@@ -570,3 +1974,6 @@ else:
     st.markdown("""<style>.stApp { background-color: #000000; color: #333333; }</style>""", unsafe_allow_html=True)
     st.warning("⚠️ **Acceso Restringido**")
     st.write("Esta aplicación requiere un enlace de acceso seguro personal.")
+
+anotar_tiempo(fase_recarga, (time.perf_counter() - inicio_recarga) * 1000)
+contar(f"sheets.peticiones:{fase_recarga}", peticiones_del_hilo())
@@ -0,0 +1,93 @@
+"""Generador de datos realistas para el banco: empleados, calendario laboral y fichajes firmados.
+Con la misma semilla y el mismo día de referencia sale siempre lo mismo, así las mediciones son comparables."""
+import math
+import random
+import uuid
+from datetime import date, datetime, timedelta
+
+NOMBRES = ["Ana", "Luis", "Marta", "Javier", "Lucía", "Carlos", "Elena", "Pablo", "Sara", "Diego",
+           "Laura", "Miguel", "Paula", "Jorge", "Carmen", "Raúl", "Irene", "Sergio", "Nuria", "Andrés"]
+APELLIDOS = ["García", "Martínez", "López", "Sánchez", "Pérez", "Gómez", "Martín", "Jiménez", "Ruiz",
+             "Hernández", "Díaz", "Moreno", "Álvarez", "Romero", "Navarro", "Torres", "Domínguez", "Gil"]
+DISPOSITIVOS = [
+    "Mozilla/5.0 (Linux; Android 14; SM-A546B) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/126.0 Mobile Safari/537.36",
+    "Mozilla/5.0 (iPhone; CPU iPhone OS 17_5 like Mac OS X) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/17.5 Mobile/15E148 Safari/604.1",
+    "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/126.0 Safari/537.36",
+]
+FESTIVOS = [((1, 1), "Año Nuevo"), ((1, 6), "Reyes"), ((5, 1), "Día del Trabajo"), ((8, 15), "Asunción"),
+            ((10, 12), "Fiesta Nacional"), ((12, 8), "Inmaculada"), ((12, 25), "Navidad")]
+CABECERA_FICHAJES = ["Fecha", "Hora", "Empleado", "Tipo", "Dispositivo", "Firma"]
+CABECERA_USUARIOS = ["ID", "Nombre"]
+CABECERA_CALENDARIO = ["Fecha", "Tipo", "Empleado", "Motivo"]
+
+
+def generar_empleados(n, rnd):
+    nombres = []
+    for i in range(n):
+        base = f"{rnd.choice(NOMBRES)} {rnd.choice(APELLIDOS)}"
+        nombres.append(base if base not in nombres else f"{base} {i}")
+    return [[str(uuid.UUID(int=rnd.getrandbits(128))), nombre] for nombre in nombres]
+
+
+def generar_calendario(empleados, desde, hasta, rnd):
+    """Festivos nacionales de cada año del rango y dos bloques de vacaciones por empleado y año"""
+    filas = []
+    for anio in range(desde.year, hasta.year + 1):
+        for (mes, dia), motivo in FESTIVOS:
+            d = date(anio, mes, dia)
+            if desde <= d <= hasta: filas.append([d.strftime("%d/%m/%Y"), "GLOBAL", "", motivo])
+        for nombre in empleados:
+            for _ in range(2):
+                inicio = date(anio, 1, 1) + timedelta(days=rnd.randrange(0, 360))
+                for i in range(rnd.randint(5, 10)):
+                    d = inicio + timedelta(days=i)
+                    if desde <= d <= hasta and d.weekday() < 5:
+                        filas.append([d.strftime("%d/%m/%Y"), "INDIVIDUAL", nombre, "Vacaciones"])
+    return filas
+
+
+def generar_fichajes(empleados, n_filas, hoy, calendario, firmar, rnd):
+    """Una ENTRADA y una SALIDA por empleado y día laborable, hacia atrás desde hoy hasta reunir n_filas.
+    Incluye el ruido que se ve en producción: salidas olvidadas, salidas auto-programadas, fichajes
+    manuales sin firma y alguna firma alterada. Hoy solo hay entradas: la plantilla está dentro."""
+    festivos = {f for f, tipo, _, _ in calendario if tipo == "GLOBAL"}
+    ausencias = {(f, e) for f, tipo, e, _ in calendario if tipo == "INDIVIDUAL"}
+    dias, d = [], hoy
+    while len(dias) * len(empleados) * 2 < n_filas * 1.15 + 2 * len(empleados):
+        if d.weekday() < 5 and d.strftime("%d/%m/%Y") not in festivos: dias.append(d)
+        d -= timedelta(days=1)
+    filas = []
+    for d in reversed(dias):
+        fecha = d.strftime("%d/%m/%Y")
+        del_dia = []
+        for nombre in empleados:
+            if (fecha, nombre) in ausencias: continue
+            disp = rnd.choice(DISPOSITIVOS)
+            entrada = datetime.combine(d, datetime.min.time()) + timedelta(seconds=rnd.randint(7 * 3600, 9 * 3600 + 1800))
+            del_dia.append((entrada, nombre, "ENTRADA", disp))
+            if d == hoy or rnd.random() < 0.03: continue
+            salida = entrada + timedelta(seconds=rnd.randint(6 * 3600, 10 * 3600))
+            del_dia.append((salida, nombre, "SALIDA", f"{disp} (Auto-Programada)" if rnd.random() < 0.05 else disp))
+        for momento, nombre, tipo, disp in sorted(del_dia, key=lambda x: x[0]):
+            hora = momento.strftime("%H:%M:%S")
+            azar = rnd.random()
+            if azar < 0.01: firma = ""
+            elif azar < 0.012: firma = "0" * 64
+            else: firma = firmar(fecha, hora, nombre, tipo, disp)
+            filas.append([fecha, hora, nombre, tipo, disp, firma])
+    return filas[-n_filas:]
+
+
+def generar_datos(n_filas, n_empleados, firmar, hoy=None, semilla=1):
+    """{"Usuarios", "Calendario", "Hoja 1"}: filas de cada hoja con su cabecera"""
+    rnd = random.Random(semilla)
+    hoy = hoy or date.today()
+    usuarios = generar_empleados(n_empleados, rnd)
+    nombres = [n for _, n in usuarios]
+    anios = max(1, math.ceil(n_filas / (n_empleados * 2 * 230)))
+    desde = date(hoy.year - anios, 1, 1)
+    calendario = generar_calendario(nombres, desde, date(hoy.year, 12, 31), rnd)
+    fichajes = generar_fichajes(nombres, n_filas, hoy, calendario, firmar, rnd)
+    return {"Usuarios": [CABECERA_USUARIOS] + usuarios,
+            "Calendario": [CABECERA_CALENDARIO] + calendario,
+            "Hoja 1": [CABECERA_FICHAJES] + fichajes}
@@ -0,0 +1,306 @@
+"""Banco de pruebas de rendimiento de la app, sin Google Sheets.
+
+Carga la lógica de app.py (todo lo anterior a la interfaz), la conecta a un libro falso en memoria
+relleno con datos sintéticos y cronometra las operaciones que pagan los usuarios: estado del empleado,
+comprobación de festivos, etapas de la auditoría y calendario de equipo.
+
+    python bench/ejecutar.py --filas 10000 100000
+    python bench/ejecutar.py --filas 1000000 --etapas estado puede_fichar horas --repeticiones 5
+    python bench/ejecutar.py --filas 10000 --etapas carga --latencia 0.3 --cuota-lecturas 60
+
+Cada ejecución añade una línea por tamaño a bench/resultados.jsonl y se compara con la última
+medición de los mismos parámetros, para ver la evolución de una versión a otra."""
+import argparse
+import ast
+import json
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import types
+from datetime import datetime
+
+import pandas as pd
+import streamlit.config
+import streamlit.logger
+
+DIR_BENCH = os.path.dirname(os.path.abspath(__file__))
+RAIZ = os.path.dirname(DIR_BENCH)
+sys.path.insert(0, DIR_BENCH)
+
+from datos_sinteticos import generar_datos  # noqa: E402
+from hoja_falsa import LibroFalso, ServidorFalso  # noqa: E402
+
+RUTA_APP = os.path.join(RAIZ, "app.py")
+RUTA_RESULTADOS = os.path.join(DIR_BENCH, "resultados.jsonl")
+MARCA_INTERFAZ = "# --- INTERFAZ PRINCIPAL ---"
+MODULOS_BAJO_DEMANDA = ["openpyxl", "streamlit_calendar", "streamlit_javascript", "oauth2client.service_account"]
+SECRETOS_BENCH = {"SECRET_KEY": "bench", "ADMIN_PASSWORD": "", "INSPECTION_PASSWORD": "",
+                  "SHEET_NAME": "bench", "APP_URL": "http://localhost:8501", "CACHE_COMPARTIDA": "", "REPLICAS": 1}
+
+
+# --- CARGA DE LA APP ---
+def es_configuracion(nodo):
+    """st.set_page_config y el bloque de secretos: fuera de 'streamlit run' no hay página ni secrets.toml"""
+    if isinstance(nodo, ast.Expr) and isinstance(nodo.value, ast.Call):
+        return ast.unparse(nodo.value.func) == "st.set_page_config"
+    return isinstance(nodo, ast.Try) and "st.secrets" in ast.unparse(nodo)
+
+
+def cargar_app(directorio):
+    """Módulo con las funciones y constantes de app.py, sin ejecutar la interfaz.
+    La cola de fichajes y las instantáneas van a 'directorio' para no tocar las de verdad."""
+    # Fuera de 'streamlit run' cada st.* avisa de que no hay sesión. Al leer la configuración streamlit
+    # vuelve a fijar el nivel de log, así que se lee antes y se baja después.
+    streamlit.config.get_config_options()
+    streamlit.logger.set_log_level("error")
+    with open(RUTA_APP, encoding="utf-8") as f: fuente = f.read()
+    fin = next(i for i, linea in enumerate(fuente.splitlines(), 1) if linea.startswith(MARCA_INTERFAZ))
+    cuerpo = [n for n in ast.parse(fuente).body if n.lineno < fin and not es_configuracion(n)]
+    app = types.ModuleType("app")
+    app.__file__ = RUTA_APP
+    app.__dict__.update(SECRETOS_BENCH)
+    exec(compile(ast.Module(cuerpo, type_ignores=[]), RUTA_APP, "exec"), app.__dict__)
+    app.DIR_INSTANTANEAS = os.path.join(directorio, "instantaneas")
+    app.RUTA_COLA = os.path.join(directorio, "cola_fichajes.jsonl")
+    app.programar_instantanea = lambda esp, nombre_hoja: None # Escribir Parquet en segundo plano falsearía los tiempos
+    return app
+
+
+def conectar_libro(app, libro):
+    pool = app.pool_conexiones()
+    with pool["lock"]:
+        pool["cliente"], pool["libro"] = object(), libro
+        pool["hojas"].clear()
+
+
+def reiniciar_espejos(app):
+    """Vuelve al arranque en frío: sin espejos, índices ni memo de firmas"""
+    app.espejo_hoja.clear()
+    app.registro_espejos().clear()
+    app.memo_firmas.clear()
+
+
+# --- MEDICIÓN ---
+def medir(funcion, repeticiones, preparar=None):
+    """Tiempos en ms de 'repeticiones' llamadas; 'preparar' corre antes de cada una y no cuenta"""
+    tiempos = []
+    for _ in range(repeticiones):
+        if preparar: preparar()
+        t = time.perf_counter()
+        funcion()
+        tiempos.append((time.perf_counter() - t) * 1000)
+    return tiempos
+
+
+def resumen(tiempos):
+    orden = sorted(tiempos)
+    return {"n": len(orden), "min_ms": round(orden[0], 3), "mediana_ms": round(statistics.median(orden), 3),
+            "p95_ms": round(orden[min(len(orden) - 1, int(len(orden) * 0.95))], 3)}
+
+
+def quitar_indice(app, nombre_hoja, clave):
+    return lambda: app.espejo_hoja(nombre_hoja)["indices"].pop(clave, None)
+
+
+# --- ETAPAS ---
+# Cada etapa devuelve {medida: tiempos}. 'ctx' lleva la app, los datos generados y los parámetros.
+def etapa_carga(ctx):
+    app, libro = ctx["app"], ctx["libro"]
+    def preparar():
+        reiniciar_espejos(app)
+        conectar_libro(app, libro)
+    return {"carga_fria_hoja1": medir(app.cargar_datos_registros, ctx["repeticiones"], preparar)}
+
+
+def etapa_estado(ctx):
+    app, rnd = ctx["app"], random.Random(2)
+    nombres = ctx["nombres"]
+    return {
+        "estado_primera": medir(lambda: app.obtener_estado_actual(nombres[0]), ctx["repeticiones"],
+                                quitar_indice(app, "Hoja 1", "estado")),
+        "estado": medir(lambda: app.obtener_estado_actual(rnd.choice(nombres)), ctx["repeticiones"] * 100),
+    }
+
+
+def etapa_puede_fichar(ctx):
+    app, rnd = ctx["app"], random.Random(3)
+    nombres = ctx["nombres"]
+    return {
+        "puede_fichar_primera": medir(lambda: app.puede_fichar_hoy(nombres[0]), ctx["repeticiones"],
+                                      quitar_indice(app, "Calendario", "calendario")),
+        "puede_fichar": medir(lambda: app.puede_fichar_hoy(rnd.choice(nombres)), ctx["repeticiones"] * 100),
+    }
+
+
+def etapa_verificacion(ctx):
+    app = ctx["app"]
+    def preparar():
+        quitar_indice(app, "Hoja 1", "integridad")()
+        app.memo_firmas("Hoja 1").clear()
+    return {"verificacion_firmas": medir(app.registros_verificados, ctx["repeticiones"], preparar)}
+
+
+def marco_de_auditoria(ctx):
+    df, _ = ctx["app"].registros_de_mes("Todos", {})
+    return df
+
+
+def etapa_marco(ctx):
+    app = ctx["app"]
+    app.registros_verificados()
+    def preparar():
+        for clave in ("marco", "verificado", "vista:Hoja 1"): quitar_indice(app, "Hoja 1", clave)()
+    return {"marco_fichajes": medir(lambda: app.registros_de_mes("Todos", {}), ctx["repeticiones"], preparar),
+            "marco_fichajes_recarga": medir(lambda: app.registros_de_mes("Todos", {}), ctx["repeticiones"] * 10)}
+
+
+def etapa_horas(ctx):
+    app = ctx["app"]
+    df = marco_de_auditoria(ctx)
+    def resumen_mensual():
+        horas, _ = app.agregado_horas("Todos", {})
+        return horas.groupby(['Mes', 'Empleado'], sort=False, observed=True)['Segundos'].sum()
+    # Los datos sintéticos siempre traen salidas olvidadas; un mes cerrado o una tarde con todos fuera no
+    _, sueltos = app.emparejar_fichajes(df)
+    emparejados = df.drop(index=sueltos.index)
+    def agregado_sin_sueltos():
+        horas, sueltos = app.tablas_agregado(app.construir_agregado([emparejados], ()))
+        assert sueltos.empty and len(horas)
+    return {"horas_emparejado": medir(lambda: app.emparejar_fichajes(df), ctx["repeticiones"]),
+            "horas_agregado_primera": medir(lambda: app.agregado_horas("Todos", {}), ctx["repeticiones"],
+                                            quitar_indice(app, "Hoja 1", "horas:Hoja 1")),
+            "horas_agregado_sin_sueltos": medir(agregado_sin_sueltos, ctx["repeticiones"]),
+            "horas_resumen_mensual": medir(resumen_mensual, ctx["repeticiones"] * 10)}
+
+
+def etapa_excel(ctx):
+    app = ctx["app"]
+    df = marco_de_auditoria(ctx).reindex(columns=['Fecha', 'Hora', 'Empleado', 'Tipo', 'Estado', 'Dispositivo'])
+    return {"informe_excel": medir(lambda: app.generar_informe(df, "xlsx", "Todos", "Todos", 0), ctx["repeticiones"],
+                                   app.generar_informe.clear)}
+
+
+def etapa_calendario(ctx):
+    app, rnd = ctx["app"], random.Random(4)
+    indivs = sorted(app.eventos_calendario()["empleados"])
+    nombre = ctx["nombres"][0]
+    return {
+        "eventos_calendario_primera": medir(lambda: app.construir_eventos_equipo(nombre, indivs), ctx["repeticiones"],
+                                           quitar_indice(app, "Calendario", "eventos")),
+        "eventos_calendario": medir(lambda: app.construir_eventos_equipo(nombre, rnd.sample(indivs, len(indivs) // 2)),
+                                    ctx["repeticiones"] * 10),
+    }
+
+
+def importar_en_frio(codigo, medido):
+    """ms de ejecutar 'medido' tras 'codigo' en un intérprete nuevo (streamlit ya está cargado, como en el servidor)"""
+    programa = f"import streamlit, time\n{codigo}\nt = time.perf_counter()\n{medido}\nprint((time.perf_counter() - t) * 1000)"
+    salida = subprocess.run([sys.executable, "-c", programa], cwd=RAIZ, capture_output=True, text=True, check=True)
+    return float(salida.stdout.split()[-1])
+
+
+def etapa_arranque(ctx):
+    """Lo que paga la primera recarga del proceso por las importaciones de app.py y lo que pagaría
+    la primera rama que necesita cada módulo bajo demanda. No depende del tamaño de los datos."""
+    with open(RUTA_APP, encoding="utf-8") as f: arbol = ast.parse(f.read())
+    importaciones = "\n".join(ast.unparse(n) for n in arbol.body if isinstance(n, (ast.Import, ast.ImportFrom)))
+    medidas = {"importaciones_arranque": [importar_en_frio("", importaciones) for _ in range(ctx["repeticiones"])]}
+    for modulo in MODULOS_BAJO_DEMANDA:
+        medidas[f"importar:{modulo}"] = [importar_en_frio(importaciones, f"import {modulo}") for _ in range(ctx["repeticiones"])]
+    return medidas
+
+
+ETAPAS = {"carga": etapa_carga, "estado": etapa_estado, "puede_fichar": etapa_puede_fichar,
+          "verificacion": etapa_verificacion, "marco": etapa_marco, "horas": etapa_horas,
+          "excel": etapa_excel, "calendario": etapa_calendario, "arranque": etapa_arranque}
+
+
+# --- INFORME ---
+def commit_actual():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=RAIZ, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def ultima_medicion(parametros):
+    if not os.path.exists(RUTA_RESULTADOS): return None
+    anterior = None
+    with open(RUTA_RESULTADOS, encoding="utf-8") as f:
+        for linea in f:
+            try: r = json.loads(linea)
+            except ValueError: continue
+            if r.get("parametros") == parametros: anterior = r
+    return anterior
+
+
+def imprimir(registro, anterior):
+    p = registro["parametros"]
+    print(f"\n== {p['filas']:,} fichajes · {p['empleados']} empleados · latencia {p['latencia']} s · commit {registro['commit']} ==")
+    if anterior: print(f"   (comparado con {anterior['commit']} del {anterior['fecha']})")
+    ancho = max([24] + [len(m) + 2 for m in registro["medidas"]])
+    print(f"{'medida':<{ancho}}{'n':>6}{'min ms':>12}{'mediana ms':>13}{'p95 ms':>12}{'antes ms':>12}{'Δ':>9}")
+    for medida, r in registro["medidas"].items():
+        previa = (anterior or {}).get("medidas", {}).get(medida)
+        antes, delta = "", ""
+        if previa:
+            antes = f"{previa['mediana_ms']:.3f}"
+            if previa["mediana_ms"]: delta = f"{(r['mediana_ms'] / previa['mediana_ms'] - 1) * 100:+.1f}%"
+        print(f"{medida:<{ancho}}{r['n']:>6}{r['min_ms']:>12.3f}{r['mediana_ms']:>13.3f}{r['p95_ms']:>12.3f}{antes:>12}{delta:>9}")
+    llamadas = ", ".join(f"{k}={v}" for k, v in sorted(registro["peticiones"].items())) or "ninguna"
+    print(f"peticiones a la hoja falsa: {llamadas}")
+    if registro["rechazadas_429"]: print(f"rechazadas por cuota (429): {registro['rechazadas_429']}")
+
+
+def ejecutar(args):
+    with tempfile.TemporaryDirectory(prefix="bench_asistencia_") as directorio:
+        app = cargar_app(directorio)
+        for n_filas in args.filas:
+            parametros = {"filas": n_filas, "empleados": args.empleados, "latencia": args.latencia,
+                          "cuota_lecturas": args.cuota_lecturas, "cuota_escrituras": args.cuota_escrituras,
+                          "semilla": args.semilla}
+            t = time.perf_counter()
+            datos = generar_datos(n_filas, args.empleados, app.generar_firma, app.obtener_ahora().date(), args.semilla)
+            print(f"Datos sintéticos: {len(datos['Hoja 1']) - 1:,} fichajes y {len(datos['Calendario']) - 1:,} "
+                  f"días de calendario en {time.perf_counter() - t:.1f} s")
+            servidor = ServidorFalso(args.latencia, args.cuota_lecturas, args.cuota_escrituras)
+            libro = LibroFalso(servidor)
+            for titulo, valores in datos.items(): libro.crear_hoja(titulo, valores)
+            reiniciar_espejos(app)
+            conectar_libro(app, libro)
+
+            ctx = {"app": app, "libro": libro, "nombres": [n for _, n in datos["Usuarios"][1:]],
+                   "repeticiones": args.repeticiones}
+            medidas = {}
+            for etapa in args.etapas:
+                for medida, tiempos in ETAPAS[etapa](ctx).items(): medidas[medida] = resumen(tiempos)
+
+            registro = {"fecha": datetime.now().isoformat(timespec="seconds"), "commit": commit_actual(),
+                        "python": platform.python_version(), "pandas": pd.__version__, "parametros": parametros,
+                        "medidas": medidas, "peticiones": dict(servidor.llamadas), "rechazadas_429": dict(servidor.rechazadas)}
+            imprimir(registro, ultima_medicion(parametros))
+            if not args.sin_guardar:
+                with open(RUTA_RESULTADOS, "a", encoding="utf-8") as f: f.write(json.dumps(registro, ensure_ascii=False) + "\n")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Banco de pruebas de rendimiento del control de asistencia")
+    parser.add_argument("--filas", type=int, nargs="+", default=[10000, 100000], help="tamaños del registro de fichajes")
+    parser.add_argument("--empleados", type=int, default=300)
+    parser.add_argument("--repeticiones", type=int, default=3, help="repeticiones por medida (x100 en las consultas rápidas)")
+    parser.add_argument("--etapas", nargs="+", choices=list(ETAPAS), default=list(ETAPAS))
+    parser.add_argument("--latencia", type=float, default=0.0, help="segundos por petición a la hoja falsa")
+    parser.add_argument("--cuota-lecturas", type=int, default=None, help="lecturas por minuto antes de devolver 429")
+    parser.add_argument("--cuota-escrituras", type=int, default=None, help="escrituras por minuto antes de devolver 429")
+    parser.add_argument("--semilla", type=int, default=1)
+    parser.add_argument("--sin-guardar", action="store_true", help="no añadir la medición a bench/resultados.jsonl")
+    ejecutar(parser.parse_args())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,150 @@
+"""Sustituto en memoria de gspread (Spreadsheet y Worksheet) para medir la app sin Google Sheets.
+Cada llamada cuenta como una petición de lectura o de escritura: se le puede añadir latencia y una cuota
+por minuto que, al superarse, responde con un APIError 429 como haría Google."""
+import re
+import threading
+import time
+from collections import Counter, deque
+
+import gspread
+
+
+class RespuestaFalsa:
+    """Lo mínimo de requests.Response que necesita gspread.exceptions.APIError"""
+    def __init__(self, codigo, mensaje):
+        self.status_code, self.text = codigo, mensaje
+        self._json = {"error": {"code": codigo, "message": mensaje, "status": "RESOURCE_EXHAUSTED"}}
+
+    def json(self):
+        return self._json
+
+
+class ServidorFalso:
+    """Latencia, cuotas (peticiones por minuto, None = sin límite) y contadores compartidos por todas las hojas"""
+    def __init__(self, latencia=0.0, cuota_lecturas=None, cuota_escrituras=None):
+        self.latencia = latencia
+        self.cuotas = {"lectura": cuota_lecturas, "escritura": cuota_escrituras}
+        self.ventanas = {"lectura": deque(), "escritura": deque()}
+        self.llamadas, self.rechazadas = Counter(), Counter()
+        self.lock = threading.Lock()
+
+    def peticion(self, tipo, metodo):
+        with self.lock:
+            ahora, ventana = time.monotonic(), self.ventanas[tipo]
+            while ventana and ahora - ventana[0] >= 60: ventana.popleft()
+            cuota = self.cuotas[tipo]
+            if cuota is not None and len(ventana) >= cuota:
+                self.rechazadas[metodo] += 1
+                raise gspread.exceptions.APIError(RespuestaFalsa(429, f"Quota exceeded ({tipo})"))
+            ventana.append(ahora)
+            self.llamadas[metodo] += 1
+        if self.latencia: time.sleep(self.latencia)
+
+
+def columna(letras):
+    n = 0
+    for c in letras: n = n * 26 + ord(c) - 64
+    return n
+
+
+class HojaFalsa:
+    def __init__(self, libro, titulo, id_hoja, valores=None):
+        self.spreadsheet, self.title, self.id = libro, titulo, id_hoja
+        self.valores = [[str(v) for v in f] for f in (valores or [])]
+        self.lock = threading.Lock()
+
+    def _peticion(self, tipo, metodo):
+        self.spreadsheet.servidor.peticion(tipo, metodo)
+
+    def _rango(self, rango):
+        """(fila inicial, fila final o None, primera columna, última columna o None) de 'A2:F', 'A5:F5'..."""
+        m = re.fullmatch(r"([A-Z]+)(\d+)(?::([A-Z]+)(\d+)?)?", rango.split("!")[-1])
+        if not m: raise ValueError(f"Rango no soportado: {rango}")
+        c1, f1, c2, f2 = m.groups()
+        fin = int(f2) if f2 else (None if c2 else int(f1))
+        return int(f1), fin, columna(c1), columna(c2) if c2 else columna(c1)
+
+    def get_all_values(self):
+        self._peticion("lectura", "get_all_values")
+        with self.lock: return [list(f) for f in self.valores]
+
+    def get_values(self, rango):
+        self._peticion("lectura", "get_values")
+        f1, f2, c1, c2 = self._rango(rango)
+        with self.lock: filas = self.valores[f1 - 1:f2]
+        return [f[c1 - 1:c2] for f in filas]
+
+    def get_all_records(self):
+        self._peticion("lectura", "get_all_records")
+        with self.lock:
+            if not self.valores: return []
+            cabecera = self.valores[0]
+            return [dict(zip(cabecera, gspread.utils.numericise_all(f + [""] * (len(cabecera) - len(f)))))
+                    for f in self.valores[1:]]
+
+    def append_row(self, values, **kwargs):
+        return self._anadir([values], "append_row")
+
+    def append_rows(self, values, **kwargs):
+        return self._anadir(values, "append_rows")
+
+    def _anadir(self, filas, metodo):
+        self._peticion("escritura", metodo)
+        with self.lock:
+            inicio = len(self.valores) + 1
+            self.valores.extend([str(v) for v in f] for f in filas)
+            fin = len(self.valores)
+        ultima = gspread.utils.rowcol_to_a1(fin, max((len(f) for f in filas), default=1))
+        return {"updates": {"updatedRange": f"'{self.title}'!A{inicio}:{ultima}", "updatedRows": len(filas)}}
+
+    def _escribir(self, rango, valores):
+        f1, _, c1, _ = self._rango(rango)
+        for i, fila in enumerate(valores):
+            n = f1 - 1 + i
+            while len(self.valores) <= n: self.valores.append([])
+            actual = self.valores[n] + [""] * max(0, c1 - 1 + len(fila) - len(self.valores[n]))
+            actual[c1 - 1:c1 - 1 + len(fila)] = [str(v) for v in fila]
+            self.valores[n] = actual
+
+    def update(self, values=None, range_name=None, **kwargs):
+        self._peticion("escritura", "update")
+        with self.lock: self._escribir(range_name, values)
+
+    def batch_update(self, data, **kwargs):
+        self._peticion("escritura", "batch_update")
+        with self.lock:
+            for bloque in data: self._escribir(bloque["range"], bloque["values"])
+
+    def clear(self):
+        self._peticion("escritura", "clear")
+        with self.lock: self.valores = []
+
+
+class LibroFalso:
+    def __init__(self, servidor=None):
+        self.servidor = servidor or ServidorFalso()
+        self.hojas = {}
+
+    def crear_hoja(self, titulo, valores=None):
+        """Alta directa de una hoja con datos, sin pasar por la cuota (para preparar el banco)"""
+        self.hojas[titulo] = HojaFalsa(self, titulo, len(self.hojas), valores)
+        return self.hojas[titulo]
+
+    def worksheet(self, titulo):
+        self.servidor.peticion("lectura", "worksheet")
+        if titulo not in self.hojas: raise gspread.exceptions.WorksheetNotFound(titulo)
+        return self.hojas[titulo]
+
+    def add_worksheet(self, title, rows=100, cols=26, **kwargs):
+        self.servidor.peticion("escritura", "add_worksheet")
+        return self.crear_hoja(title)
+
+    def batch_update(self, body):
+        """Solo las peticiones que usa la app: deleteDimension de filas"""
+        self.servidor.peticion("escritura", "spreadsheet.batch_update")
+        por_id = {h.id: h for h in self.hojas.values()}
+        for peticion in body.get("requests", []):
+            r = peticion["deleteDimension"]["range"]
+            hoja = por_id[r["sheetId"]]
+            with hoja.lock: del hoja.valores[r["startIndex"]:r["endIndex"]]
+        return {}